@@ -1,13 +1,30 @@
+import time
+
+# Process start, for the startup time benchmark
+STARTUP_TIME = time.perf_counter()
+
+if __name__ == "__main__":
+    # With a command, or when AI Snip already runs, this process is only a client
+    # of the running one, which has the model client and widgets ready. Before
+    # the Qt imports, so that this takes milliseconds.
+    import client
+
+    client.run_or_forward()
+
 import sys
 import os
+import json
+import threading
 from datetime import datetime
-from PyQt6.QtCore import Qt, QRect
+from PyQt6.QtCore import Qt, QRect, QRectF, QThreadPool, QTimer
 from PyQt6.QtGui import (
+    QCursor,
     QPainter,
     QPen,
     QPixmap,
     QScreen,
     QColor,
+    QImage,
     QKeySequence,
     QIcon,
     QAction,
@@ -17,70 +34,272 @@ from PyQt6.QtWidgets import (
     QApplication,
     QWidget,
     QFileDialog,
+    QInputDialog,
     QMainWindow,
     QMenu,
     QSystemTrayIcon,
 )
 from util import (
-    local_image_to_data_url,
-    AzureModelWrapper,
+    image_bytes_to_data_url,
+    image_content,
+    text_content,
+    estimate_image_tokens,
+    BackgroundWriter,
+    close_http_client,
+    DATA_DIR,
+    PROMPT_PRESETS,
+    model_from_env,
     OpenAIModelWrapper,
+    AzureModelWrapper,
     ModelWrapper,
     resource_path
 )
 from speech_bubble import SpeechBubbleWidget
+from multi_answer import MultiAnswerWidget
 from write_text import TextInputWidget
 from get_text_input import TextInputCapture
+from worker import CompletionWorker
+from imaging import (
+    image_to_bytes,
+    snip_hash,
+    preprocess_image,
+    PreprocessPolicy,
+    SharedEncoding,
+)
+from cache import make_cache_key, ResponseCache
+from metrics import Metrics, Trace
+from watch import RegionWatcher
+from history import HistoryStore
+from router import ModelRouter
+from hedge import HedgedModelWrapper
+from local_model import FallbackModelWrapper, LocalModelWrapper
+from ocr import OcrEngine, OcrStats, ocr_engine_from_env
+from ipc import IpcServer
 import pyperclip
-import keyboard
-import time
+
+
+class SnipRequest:
+    # What a worker needs to answer prompt for an image. model and cache_key are
+    # filled in by SnippingTool.start_request.
+    def __init__(
+        self, image, image_hash, prompt, preset, trace, archive_path=None, encoding=None
+    ):
+        self.image = image
+        self.image_hash = image_hash
+        self.prompt = prompt
+        self.preset = preset
+        self.trace = trace
+        # None if the image is not to be archived by the worker
+        self.archive_path = archive_path
+        # The encoding shared by the requests of a fan-out, if it is one of them
+        self.encoding = encoding
+        self.model = None
+        self.cache_key = None
 
 
 class SnippingTool(QMainWindow):
-    def __init__(self, model: ModelWrapper):
+    def __init__(
+        self,
+        model: ModelWrapper,
+        history: HistoryStore = None,
+        freeze_screen: bool = True,
+        router: ModelRouter = None,
+        ocr: OcrEngine = None,
+    ):
         super().__init__()
         self.setWindowFlags(
             Qt.WindowType.FramelessWindowHint | Qt.WindowType.WindowStaysOnTopHint
         )
         self.setWindowOpacity(0.2)
+        # Grab the screens once when the overlay opens and show that frozen frame,
+        # instead of a see-through overlay and a grab after the selection
+        self.freeze_screen = freeze_screen
+        self.frozen_frame = None
 
         screen_geometry = QApplication.primaryScreen().geometry()
         self.setGeometry(screen_geometry)
 
         self.save_folder = os.path.expanduser("~/Pictures/snips")
         os.makedirs(self.save_folder, exist_ok=True)
+        self.archive_writer = BackgroundWriter()
 
         self.begin = None
         self.end = None
         self.clippy_enabled = True
         self.clipboard_enabled = False
+        self.preset = "explain"
+        # Watch the snipped region after answering it once
+        self.watch_enabled = False
+        # Answer all prompt presets at once
+        self.fan_out_enabled = False
+
+        # How the snip is prepared for upload, per prompt preset
+        self.preprocess_policies = {
+            "default": PreprocessPolicy(),
+            "translate": PreprocessPolicy(grayscale=True),
+            "latex": PreprocessPolicy(grayscale=True),
+        }
+        # Snips of these presets are usually just text. If OCR recognizes it with
+        # at least ocr_min_confidence, the text is sent instead of the image.
+        # Not LaTeX, the layout of formulas is lost in the recognized text.
+        self.ocr = ocr
+        self.ocr_presets = {"translate"}
+        self.ocr_min_confidence = 0.85
+        self.ocr_stats = OcrStats()
 
         self.model = model
+        # Picks the model per snip if set, otherwise every snip goes to model
+        self.router = router
+        # Every answered snip is recorded here if set
+        self.history = history
+
+        # Static semi-transparent layer, only the dirty region of it is repainted
+        self.overlay_layer = QPixmap()
+        # Called with the duration of every paintEvent in ms and the painted rect
+        self.frame_time_hook = None
+
+        # Latency of the pipeline stages, the trace of the current overlay and
+        # the trace of the reply in the speech bubble
+        self.metrics = Metrics(os.path.join(DATA_DIR, "metrics.json"))
+        self.trace = None
+        self.display_trace = None
+
+        # Model requests run on the thread pool so the GUI stays responsive
+        self.thread_pool = QThreadPool.globalInstance()
+        # The requests wait on the network, a fan-out runs several at once
+        self.thread_pool.setMaxThreadCount(max(self.thread_pool.maxThreadCount(), 8))
+        self.request_counter = 0
+        self.pending = None
+        # Requests of the current fan-out, request id to (worker, preset)
+        self.fan_out = {}
+
+        # Region watch mode, see RegionWatcher for the settings
+        self.watcher = None
+        self.watch_config = {"interval_ms": 1000, "threshold": 0.02, "cpu_budget": 0.05}
+
+    @property
+    def speech_bubble(self):
+        return get_speech_bubble()
+
+    @property
+    def text_widget(self):
+        return get_text_widget()
+
+    @property
+    def multi_answer(self):
+        return get_multi_answer()
 
-    def set_model(self, model: ModelWrapper):
+    def set_model(self, model: ModelWrapper, router: ModelRouter = None):
         self.model = model
+        self.router = router
 
     def showFullScreen(self) -> None:
+        if self.isVisible():
+            # Hotkey triggered twice, keep the selection that is being made
+            return
+        self.trace = Trace(self.metrics)
+        if self.freeze_screen:
+            # Before the overlay is shown, so that it is not part of the frame
+            self.frozen_frame = self.grab_screens()
+            self.trace.mark("screen_grab")
+        self.setWindowOpacity(1.0 if self.frozen_frame is not None else 0.2)
+        self.build_overlay_layer()
         super().showFullScreen()
         self.begin = self.end = None
         self.clippy_enabled = True
         self.clipboard_enabled = False
-        text_widget.current_text = "Please explain the contents of this image concisely."
+        self.preset = "explain"
+        self.watch_enabled = False
+        self.fan_out_enabled = False
+        self.text_widget.current_text = PROMPT_PRESETS["explain"]
+        if self.model is not None:
+            # The connection is ready by the time the selection is made
+            self.model.prewarm()
         self.update()
 
+    def closeEvent(self, event):
+        # The frame is only needed while the overlay is open
+        self.frozen_frame = None
+        self.build_overlay_layer()
+        super().closeEvent(event)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.build_overlay_layer()
+
+    def build_overlay_layer(self):
+        dpr = self.devicePixelRatioF()
+        self.overlay_layer = QPixmap(self.size() * dpr)
+        self.overlay_layer.setDevicePixelRatio(dpr)
+        if self.frozen_frame is None:
+            self.overlay_layer.fill(QColor(0, 0, 0, 128))  # Semi-transparent black
+            return
+        # The frozen frame, dimmed
+        painter = QPainter(self.overlay_layer)
+        painter.drawPixmap(0, 0, self.frozen_frame)
+        painter.fillRect(self.rect(), QColor(0, 0, 0, 96))
+        painter.end()
+
+    def grab_screens(self):
+        # One frame of all screens under the overlay, in window coordinates and
+        # at the highest pixel ratio among them. None if there is nothing to grab.
+        area = self.geometry()
+        screens = [s for s in QApplication.screens() if s.geometry().intersects(area)]
+        if not screens:
+            return None
+        dpr = max(screen.devicePixelRatio() for screen in screens)
+        frame = QPixmap(area.size() * dpr)
+        frame.setDevicePixelRatio(dpr)
+        frame.fill(Qt.GlobalColor.black)
+        painter = QPainter(frame)
+        for screen in screens:
+            shot = screen.grabWindow(0)
+            target = QRectF(screen.geometry().translated(-area.topLeft()))
+            painter.drawPixmap(target, shot, QRectF(shot.rect()))
+        painter.end()
+        return frame
+
+    def selection_rect(self):
+        if self.begin is None or self.end is None:
+            return QRect()
+        return QRect(self.begin, self.end).normalized()
+
+    def update_selection(self, old_rect):
+        # Repaint only where the selection was or is now, including its border
+        dirty = old_rect.united(self.selection_rect())
+        if not dirty.isNull():
+            self.update(dirty.adjusted(-2, -2, 2, 2))
+
+    @staticmethod
+    def draw_layer(painter, layer, rect):
+        # Draw the part of a full window pixmap that lies in rect
+        dpr = layer.devicePixelRatio()
+        source = QRectF(
+            rect.x() * dpr, rect.y() * dpr, rect.width() * dpr, rect.height() * dpr
+        )
+        painter.drawPixmap(QRectF(rect), layer, source)
+
     def paintEvent(self, event):
+        start = time.perf_counter()
         painter = QPainter(self)
         painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        dirty = event.rect()
 
         # Draw the overlay with opacity
-        overlay_color = QColor(0, 0, 0, 128)  # Semi-transparent black
-        painter.fillRect(self.rect(), overlay_color)
+        self.draw_layer(painter, self.overlay_layer, dirty)
 
         # If we have a selection, cut it out to reveal the screen content
         if self.begin and self.end:
             rect = QRect(self.begin, self.end)
-            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Clear)
-            painter.fillRect(rect, Qt.GlobalColor.transparent)
+            if self.frozen_frame is not None:
+                self.draw_layer(
+                    painter, self.frozen_frame, rect.normalized().intersected(dirty)
+                )
+            else:
+                painter.setCompositionMode(
+                    QPainter.CompositionMode.CompositionMode_Clear
+                )
+                painter.fillRect(rect.intersected(dirty), Qt.GlobalColor.transparent)
 
             # Draw a red border around the selection
             painter.setCompositionMode(
@@ -89,59 +308,459 @@ class SnippingTool(QMainWindow):
             painter.setPen(QPen(Qt.GlobalColor.red, 2))
             painter.drawRect(rect)
 
-    def get_ai_complete(self, img_path):
-        data_url = local_image_to_data_url(img_path)
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": text_widget.current_text},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": data_url,
-                        },
-                    },
-                ],
-            }
-        ]
-        if self.model is None:
+        painter.end()
+        if self.trace is not None:
+            self.trace.mark("overlay")
+        if self.frame_time_hook is not None:
+            self.frame_time_hook((time.perf_counter() - start) * 1000, dirty)
+
+    def get_ai_complete(self, request, on_token=None):
+        # Runs on a worker thread, must not touch any widgets
+        image = request.image
+        use_ocr = request.preset in self.ocr_presets and self.ocr is not None
+        policy = self.preprocess_policies.get(
+            request.preset, self.preprocess_policies["default"]
+        )
+        # The full resolution PNG for the archive is encoded by the writer thread,
+        # unless it is needed for OCR anyway
+        png = image_to_bytes(image) if use_ocr else None
+        if request.archive_path is not None:
+            self.archive_writer.write(
+                request.archive_path, lambda: png or image_to_bytes(image)
+            )
+        if use_ocr:
+            text = self.recognize(png)
+            request.trace.mark("ocr")
+            if text is not None:
+                threading.Thread(
+                    target=self.record_ocr_saving,
+                    args=(image, policy, text),
+                    daemon=True,
+                ).start()
+                return self.timed_ask(
+                    "text", request, text_content(request.prompt, text), 0, on_token
+                )
+        image_data, mime_type, width, height = preprocess_image(image, policy)
+        data_url = image_bytes_to_data_url(image_data, mime_type)
+        request.trace.mark("encode")
+        return self.timed_ask(
+            "image" if use_ocr else None,
+            request,
+            image_content(request.prompt, data_url),
+            estimate_image_tokens(width, height),
+            on_token,
+        )
+
+    def recognize(self, png):
+        # The text of the snip if OCR is confident enough about it, else None
+        result = self.ocr.recognize(png)
+        used = result is not None and result.confidence >= self.ocr_min_confidence
+        self.ocr_stats.record_ocr(result, used)
+        return result.text if used else None
+
+    def record_ocr_saving(self, image, policy, text):
+        # Compared with the upload the text replaced, which is encoded for that
+        # on a thread of its own to keep it off the request path
+        image_data, mime_type, width, height = preprocess_image(image, policy)
+        image_tokens = estimate_image_tokens(width, height)
+        self.ocr_stats.record_saving(image_tokens, text, len(image_data))
+
+    def timed_ask(self, kind, request, *args):
+        # For the OCR stats, kind is "text" or "image" for the OCR presets
+        start = time.perf_counter()
+        reply = self.ask(request, *args)
+        if kind is not None and request.model is not None:
+            self.ocr_stats.record_request(kind, (time.perf_counter() - start) * 1000)
+        return reply
+
+    def get_fan_out_complete(self, request, on_token=None):
+        # Runs on a worker thread, the snip is encoded by the first request of the
+        # fan-out to get here
+        data_url, width, height = request.encoding.get()
+        request.trace.mark("encode")
+        return self.ask(
+            request,
+            image_content(request.prompt, data_url),
+            estimate_image_tokens(width, height),
+            on_token,
+        )
+
+    def ask(self, request, content, image_tokens, on_token=None):
+        # Sends the message content, on a worker thread
+        model = request.model
+        trace = request.trace
+        messages = [{"role": "user", "content": content}]
+        if model is None:
             reply = """Got no API key. Either set the OPENAI_API_KEY environment variable
             or restart AI Snip and enter your key."""
         else:
-            reply = self.model.complete(messages)
+            if image_tokens:
+                model.record_image_estimate(image_tokens)
 
-        if self.clipboard_enabled:
-            pyperclip.copy(reply)
+            def callback(token):
+                trace.mark("first_token")
+                if on_token is not None:
+                    on_token(token)
+
+            start = time.perf_counter()
+            # Joins an identical request that is still running, instead of
+            # sending another one
+            kwargs = dict(
+                stream=True,
+                callback=callback,
+                cache_key=request.cache_key,
+                on_send=lambda: trace.mark("request_sent"),
+            )
+            if self.router is not None:
+                reply = self.router.complete(model, messages, **kwargs)
+            else:
+                reply = model.complete(messages, **kwargs)
+            latency_ms = (time.perf_counter() - start) * 1000
+            trace.mark("last_token")
+            if self.history is not None:
+                usage = model.last_usage()
+                self.history.add(
+                    request.archive_path,
+                    request.image_hash,
+                    request.prompt,
+                    model.model_name,
+                    reply,
+                    usage.prompt_tokens if usage is not None else None,
+                    usage.completion_tokens if usage is not None else None,
+                    latency_ms,
+                )
         return reply
 
+    def new_archive_path(self) -> str:
+        # Milliseconds, so that snips within the same second do not overwrite
+        # each other
+        now = datetime.now()
+        name = f"{now:%Y-%m-%d_%H-%M-%S}-{now.microsecond // 1000:03d}.png"
+        return os.path.join(self.save_folder, name)
+
+    def start_completion(self, image):
+        # A new snip supersedes whatever request is still in flight
+        self.cancel_completion()
+        request = SnipRequest(
+            image,
+            snip_hash(image),
+            self.text_widget.current_text,
+            self.preset,
+            self.trace,
+            archive_path=self.new_archive_path(),
+        )
+        reply, worker = self.start_request(
+            request,
+            self.on_completion_finished,
+            self.on_completion_failed,
+            on_token=self.on_completion_token,
+        )
+        if reply is not None:
+            self.trace.mark("cache_hit")
+            self.archive_writer.write(
+                request.archive_path, lambda: image_to_bytes(image)
+            )
+            if self.history is not None:
+                self.history.add(
+                    request.archive_path,
+                    request.image_hash,
+                    request.prompt,
+                    request.model.model_name,
+                    reply,
+                    0,
+                    0,
+                )
+            self.display_trace = self.trace
+            self.show_reply(
+                reply, self.clippy_enabled, self.clipboard_enabled, animate=False
+            )
+            return
+
+        # Remember the overlay settings of this snip, the overlay may be reopened
+        # before the reply arrives. The worker's signals are queued for this
+        # thread, so none of them is handled before this returns.
+        worker.clippy_enabled = self.clippy_enabled
+        worker.clipboard_enabled = self.clipboard_enabled
+        worker.trace = self.trace
+        self.pending = worker
+        if self.clippy_enabled:
+            self.speech_bubble.show_thinking()
+            if not self.speech_bubble.isVisible():
+                self.speech_bubble.show()
+
+    def start_request(self, request, on_finished, on_failed, on_token=None):
+        # Chooses the model for request and answers it from the cache, or starts a
+        # worker that sends it. Returns the cached reply, or None and the worker,
+        # whose signals are delivered to the callbacks. Streams if on_token is
+        # given.
+        request.model = self.choose_model(request.preset, request.image, request.prompt)
+        if request.model is not None:
+            request.cache_key, reply = self.cached_reply(
+                request.model, request.image_hash, request.prompt
+            )
+            if reply is not None:
+                return reply, None
+
+        if request.encoding is None:
+            fn = self.get_ai_complete
+        else:
+            fn = self.get_fan_out_complete
+        self.request_counter += 1
+        worker = CompletionWorker(
+            self.request_counter, fn, request, streaming=on_token is not None
+        )
+        if on_token is not None:
+            worker.signals.token.connect(on_token)
+        worker.signals.finished.connect(on_finished)
+        worker.signals.failed.connect(on_failed)
+        self.thread_pool.start(worker)
+        return None, worker
+
+    def choose_model(self, preset, image, prompt):
+        if self.router is None:
+            return self.model
+        return self.router.choose(
+            preset,
+            estimate_image_tokens(image.width(), image.height()) + len(prompt) // 4,
+        )
+
+    def cached_reply(self, model, image_hash, prompt):
+        # The cache key of a request and its cached reply, if any
+        cache_key = make_cache_key(image_hash, prompt, model.model_name)
+        # Misses are counted by the worker, which looks up the key again
+        cache = model.cache
+        reply = cache.get(cache_key) if cache is not None else None
+        if reply is not None:
+            model.count("cache_hits")
+        return cache_key, reply
+
+    def start_watch(self, rect, image, prompt, preset):
+        # Keep answering prompt for the screen region rect, in global coordinates,
+        # whenever its content changes. image is its current content.
+        self.stop_watch()
+        self.watcher = RegionWatcher(rect, prompt, preset, **self.watch_config)
+        self.watcher.changed.connect(self.on_region_changed)
+        self.watcher.start(image)
+
+    def stop_watch(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def on_region_changed(self, image):
+        watcher = self.watcher
+        # Watch requests are neither archived nor part of the snip latency stats
+        request = SnipRequest(
+            image, snip_hash(image), watcher.prompt, watcher.preset, Trace(Metrics())
+        )
+        reply, worker = self.start_request(
+            request,
+            lambda request_id, reply: self.on_watch_finished(watcher, reply),
+            lambda request_id, error: self.on_watch_finished(
+                watcher, f"Request failed: {error}"
+            ),
+        )
+        if reply is not None:
+            # A snip that is being answered has the bubble
+            if self.pending is None:
+                self.show_watch_reply(reply)
+            return
+        watcher.busy = True
+
+    def on_watch_finished(self, watcher, reply):
+        watcher.busy = False
+        if watcher is self.watcher and self.pending is None:
+            self.show_watch_reply(reply)
+
+    def show_watch_reply(self, reply):
+        # Replaces the text of the bubble in place, without the typewriter
+        if self.speech_bubble.full_text != reply:
+            self.speech_bubble.reset(reply, animate=False)
+        if not self.speech_bubble.isVisible():
+            self.speech_bubble.show()
+
+    def submit_image(self, image, prompt, preset, on_done):
+        # Answers prompt for an image from elsewhere than the screen, e.g. a file
+        # sent by the command line client. on_done gets the reply and the error,
+        # one of them None, on the GUI thread.
+        # Neither archived nor part of the snip latency stats
+        request = SnipRequest(image, snip_hash(image), prompt, preset, Trace(Metrics()))
+        reply, worker = self.start_request(
+            request,
+            lambda request_id, reply: on_done(reply, None),
+            lambda request_id, error: on_done(None, error),
+        )
+        if reply is not None:
+            on_done(reply, None)
+
+    def start_fan_out(self, image):
+        # Sends every preset, and the custom prompt if there is one, for the same
+        # snip at once. The snip is encoded once for all of them, so without the
+        # grayscale of the translate and LaTeX policies.
+        self.cancel_completion()
+        archive_path = self.new_archive_path()
+        self.archive_writer.write(archive_path, lambda: image_to_bytes(image))
+        image_hash = snip_hash(image)
+        encoding = SharedEncoding(image, self.preprocess_policies["default"])
+
+        prompts = {name: prompt for name, prompt in PROMPT_PRESETS.items() if prompt}
+        custom = self.text_widget.current_text
+        if custom.strip() and custom not in prompts.values():
+            prompts["custom"] = custom
+        self.multi_answer.reset(list(prompts))
+        self.multi_answer.show()
+
+        for name, prompt in prompts.items():
+            request = SnipRequest(
+                image,
+                image_hash,
+                prompt,
+                name,
+                self.trace,
+                archive_path=archive_path,
+                encoding=encoding,
+            )
+            reply, worker = self.start_request(
+                request,
+                self.on_fan_out_finished,
+                self.on_fan_out_failed,
+                on_token=self.on_fan_out_token,
+            )
+            if reply is not None:
+                self.multi_answer.finish(name, reply, "Cached")
+            else:
+                self.fan_out[worker.request_id] = (worker, name)
+
+    def on_fan_out_token(self, request_id, token):
+        if request_id in self.fan_out:
+            self.multi_answer.append_text(self.fan_out[request_id][1], token)
+
+    def on_fan_out_finished(self, request_id, reply):
+        if request_id in self.fan_out:
+            _, name = self.fan_out.pop(request_id)
+            self.multi_answer.finish(name, reply)
+
+    def on_fan_out_failed(self, request_id, error):
+        if request_id in self.fan_out:
+            _, name = self.fan_out.pop(request_id)
+            self.multi_answer.finish(name, f"Request failed: {error}", "Failed")
+
+    def cancel_completion(self):
+        for worker, _ in self.fan_out.values():
+            worker.cancel()
+        self.fan_out = {}
+        if self.pending is None:
+            return
+        self.pending.cancel()
+        self.pending = None
+        self.speech_bubble.finish_stream()
+        if self.speech_bubble.thinking:
+            self.speech_bubble.close()
+
+    def is_pending(self, request_id):
+        # False if the request was cancelled or superseded by a newer snip
+        return self.pending is not None and self.pending.request_id == request_id
+
+    def on_completion_token(self, request_id, token):
+        if self.is_pending(request_id) and self.pending.clippy_enabled:
+            self.display_trace = self.pending.trace
+            self.speech_bubble.append_text(token)
+
+    def on_completion_finished(self, request_id, reply):
+        if not self.is_pending(request_id):
+            return
+        worker = self.pending
+        self.pending = None
+        self.speech_bubble.finish_stream()
+        self.display_trace = worker.trace
+        self.show_reply(reply, worker.clippy_enabled, worker.clipboard_enabled)
+        # Also done if the bubble is hidden or already caught up with the stream
+        bubble = self.speech_bubble
+        if not worker.clippy_enabled or (
+            bubble.char_index >= len(bubble.full_text) and not bubble.timer.isActive()
+        ):
+            self.finish_trace()
+
+    def on_first_char_shown(self):
+        if self.display_trace is not None:
+            self.display_trace.mark("first_char", record=False)
+            self.display_trace.span("release_to_first_char", "selection", "first_char")
+
+    def on_revealed(self):
+        # With streaming the bubble can catch up before the reply is complete
+        if self.pending is None or self.pending.trace is not self.display_trace:
+            self.finish_trace()
+
+    def finish_trace(self):
+        trace, self.display_trace = self.display_trace, None
+        if trace is None:
+            return
+        trace.mark("displayed")
+        trace.span("release_to_displayed", "selection", "displayed")
+        trace.span("total", "start", "displayed")
+        self.metrics.write()
+
+    def show_reply(self, reply, clippy_enabled, clipboard_enabled, animate=True):
+        if clipboard_enabled:
+            pyperclip.copy(reply)
+        # A streamed reply is already in the bubble
+        if self.speech_bubble.thinking or self.speech_bubble.full_text != reply:
+            self.speech_bubble.reset(reply, animate)
+        if clippy_enabled:
+            if not self.speech_bubble.isVisible():
+                self.speech_bubble.show()
+
+    def on_completion_failed(self, request_id, error):
+        if not self.is_pending(request_id):
+            return
+        worker = self.pending
+        self.pending = None
+        self.speech_bubble.finish_stream()
+        self.speech_bubble.reset(f"Request failed: {error}")
+        if worker.clippy_enabled:
+            if not self.speech_bubble.isVisible():
+                self.speech_bubble.show()
+
     def mousePressEvent(self, event):
+        old_rect = self.selection_rect()
         self.begin = event.pos()
         self.end = self.begin
-        self.update()
+        self.update_selection(old_rect)
 
     def mouseMoveEvent(self, event):
+        old_rect = self.selection_rect()
         self.end = event.pos()
-        self.update()
+        self.update_selection(old_rect)
 
     def mouseReleaseEvent(self, event):
         self.end = event.pos()
-        file_path = self.capture()
+        if self.trace is not None:
+            self.trace.mark("selection")
+        image = self.capture()
+        if self.trace is not None:
+            self.trace.mark("grab")
+        rect = self.selection_rect().translated(self.geometry().topLeft())
         self.begin = self.end = None
-        if file_path is not None:
+        if image is not None:
             self.close()
-            if text_widget.isVisible():
-                text_widget.close()
-            reply = self.get_ai_complete(file_path)
-            speech_bubble.reset(reply)
-            if self.clippy_enabled:
-                if not speech_bubble.isVisible():
-                    speech_bubble.show()
+            if self.text_widget.isVisible():
+                self.text_widget.close()
+            if not self.watch_enabled:
+                # The new snip's answer replaces the one of the watched region
+                self.stop_watch()
+            if self.fan_out_enabled:
+                self.start_fan_out(image)
+                return
+            self.start_completion(image)
+            if self.watch_enabled:
+                self.start_watch(
+                    rect, image, self.text_widget.current_text, self.preset
+                )
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key.Key_Escape or event.key() == Qt.Key.Key_Q:
             self.close()
-            text_widget.close()
+            self.text_widget.close()
 
         if event.key() == Qt.Key.Key_C:
             self.clipboard_enabled = not self.clipboard_enabled
@@ -149,27 +768,32 @@ class SnippingTool(QMainWindow):
         if event.key() == Qt.Key.Key_D:
             self.clippy_enabled = not self.clippy_enabled
 
+        if event.key() == Qt.Key.Key_W:
+            self.watch_enabled = not self.watch_enabled
+
+        if event.key() == Qt.Key.Key_M:
+            self.fan_out_enabled = not self.fan_out_enabled
+
         if event.key() == Qt.Key.Key_E:
-            text_widget.change_text(
-                "Translate this text to English. Only respond with the translated text."
-            )
+            self.preset = "translate"
+            self.text_widget.change_text(PROMPT_PRESETS["translate"])
             self.clipboard_enabled = True
-            if not text_widget.isVisible():
-                text_widget.show()
+            if not self.text_widget.isVisible():
+                self.text_widget.show()
 
         if event.key() == Qt.Key.Key_T:
-            text_widget.change_text("")
-            if not text_widget.isVisible():
-                text_widget.show()
+            self.preset = "custom"
+            self.text_widget.change_text(PROMPT_PRESETS["custom"])
+            if not self.text_widget.isVisible():
+                self.text_widget.show()
 
         if event.key() == Qt.Key.Key_L:
             self.clippy_enabled = False
             self.clipboard_enabled = True
-            text_widget.change_text(
-                "Give me the latex code that generates this image. Only respond with the code and nothing else."
-            )
-            if not text_widget.isVisible():
-                text_widget.show()
+            self.preset = "latex"
+            self.text_widget.change_text(PROMPT_PRESETS["latex"])
+            if not self.text_widget.isVisible():
+                self.text_widget.show()
 
     def capture(self):
         x1 = min(self.begin.x(), self.end.x())
@@ -181,15 +805,22 @@ class SnippingTool(QMainWindow):
             return None
         rect = QRect(x1, y1, x2 - x1, y2 - y1)
 
+        if self.frozen_frame is not None:
+            # Crop from the frame grabbed when the overlay opened
+            dpr = self.frozen_frame.devicePixelRatio()
+            return self.frozen_frame.copy(
+                round(rect.x() * dpr),
+                round(rect.y() * dpr),
+                round(rect.width() * dpr),
+                round(rect.height() * dpr),
+            ).toImage()
+
         screen = QApplication.primaryScreen()
         screenshot = screen.grabWindow(
             0, rect.x(), rect.y(), rect.width(), rect.height()
         )
-
-        now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        file_path = os.path.join(self.save_folder, f"{now}.png")
-        screenshot.save(file_path)
-        return file_path
+        # Encoding and archiving happen on the worker thread, which needs a QImage
+        return screenshot.toImage()
 
 
 def store_api_key(api_key):
@@ -198,53 +829,295 @@ def store_api_key(api_key):
     return api_key
 
 
-app = QApplication(sys.argv)
-app.setQuitOnLastWindowClosed(False)
+# The windows are only built when they are first needed, to get the tray icon up
+# quickly on startup
+RETENTION_INTERVAL_MS = 3600 * 1000
 
-if os.environ.get("OPENAI_API_KEY") is not None:
-    model = OpenAIModelWrapper()
-elif os.environ.get("AZURE_OPENAI_API_KEY") is not None:
-    model = AzureModelWrapper()
-elif os.path.isfile("openai_api_key.txt"):
-    with open("openai_api_key.txt") as f:
-        api_key = f.read().strip()
-    model = OpenAIModelWrapper(api_key=api_key)
-else:
-    model = None
+_window = None
+_speech_bubble = None
+_text_widget = None
+_multi_answer = None
+
+
+def get_window():
+    global _window
+    if _window is None:
+        _window = SnippingTool(
+            model, history, router=router, ocr=ocr_engine_from_env()
+        )
+    return _window
+
+
+def get_speech_bubble():
+    global _speech_bubble
+    if _speech_bubble is None:
+        _speech_bubble = SpeechBubbleWidget()
+        _speech_bubble.cancel_requested.connect(
+            lambda: get_window().cancel_completion()
+        )
+        _speech_bubble.first_char_shown.connect(
+            lambda: get_window().on_first_char_shown()
+        )
+        _speech_bubble.revealed.connect(lambda: get_window().on_revealed())
+    return _speech_bubble
+
+
+def get_multi_answer():
+    global _multi_answer
+    if _multi_answer is None:
+        _multi_answer = MultiAnswerWidget()
+        _multi_answer.cancel_requested.connect(
+            lambda: get_window().cancel_completion()
+        )
+    return _multi_answer
+
+
+def get_text_widget():
+    global _text_widget
+    if _text_widget is None:
+        _text_widget = TextInputWidget()
+    return _text_widget
+
+
+def make_router(model):
+    # Routes the presets to other models of the same backend. Azure deployment
+    # names and the models of a local server are not known, so for those only
+    # AISNIP_ROUTES is used.
+    if model is None:
+        return None
+    routes = os.environ.get("AISNIP_ROUTES")
+    if routes is not None:
+        routes = json.loads(routes)
+    elif isinstance(
+        model,
+        (
+            AzureModelWrapper,
+            HedgedModelWrapper,
+            LocalModelWrapper,
+            FallbackModelWrapper,
+        ),
+    ):
+        routes = {}
+    latency_budget = os.environ.get("AISNIP_LATENCY_BUDGET_MS")
+    cost_budget = os.environ.get("AISNIP_COST_BUDGET")
+    return ModelRouter(
+        model,
+        routes,
+        latency_budget_ms=float(latency_budget) if latency_budget else None,
+        cost_budget=float(cost_budget) if cost_budget else None,
+    )
+
+
+def load_model():
+    # Creating a model imports the OpenAI SDK, which is the slowest part of startup
+    global model, router
+    model = model_from_env(cache=response_cache)
+    router = make_router(model)
+    if _window is not None:
+        _window.set_model(model, router)
+
+
+def set_api_key(api_key):
+    global model, router
+    model = OpenAIModelWrapper(api_key=store_api_key(api_key), cache=response_cache)
+    router = make_router(model)
+    if _window is not None:
+        _window.set_model(model, router)
 
-window = SnippingTool(model)
-speech_bubble = SpeechBubbleWidget()
-text_widget = TextInputWidget()
 
-if model is None:
-    text_cap = TextInputCapture(
-        lambda x: window.set_model(OpenAIModelWrapper(api_key=store_api_key(x)))
+def apply_retention():
+    threading.Thread(target=history.apply_retention, daemon=True).start()
+
+
+def finish_startup():
+    # Runs once the event loop is up and the tray icon is shown
+    global text_cap
+    load_model()
+    if model is None:
+        text_cap = TextInputCapture(set_api_key)
+        text_cap.show()
+
+    # Deletes old archived images, which can take a while on a slow disk. Also
+    # every hour, AI Snip can keep running for weeks.
+    apply_retention()
+    retention_timer.timeout.connect(apply_retention)
+    retention_timer.start(RETENTION_INTERVAL_MS)
+
+    try:
+        import keyboard
+
+        keyboard.add_hotkey("CTRL + SHIFT + A", show_action.trigger)
+    except ImportError as e:
+        # The keyboard hook needs root on Linux, the tray menu still works
+        print(f"Could not register the hotkey: {e}", file=sys.stderr)
+
+    if os.environ.get("AISNIP_EXIT_AFTER_STARTUP"):
+        print(f"ready_ms={(time.perf_counter() - STARTUP_TIME) * 1000:.1f}")
+        app.quit()
+
+
+def latency_stats():
+    text = get_window().metrics.format()
+    if router is not None:
+        text += "\n\n" + router.format()
+    if isinstance(model, (HedgedModelWrapper, FallbackModelWrapper)):
+        text += "\n\n" + model.format()
+    if get_window().ocr is not None:
+        text += "\n\n" + get_window().ocr_stats.format()
+    return text
+
+
+def show_latency_stats():
+    bubble = get_speech_bubble()
+    bubble.reset(latency_stats(), animate=False)
+    bubble.show()
+
+
+def handle_snip(request, respond):
+    # Commands of the command line client and of further instances, see ipc.py
+    get_window().showFullScreen()
+    respond({"ok": True})
+
+
+def handle_ask(request, respond):
+    path = request.get("image")
+    image = QImage(path) if isinstance(path, str) else QImage()
+    if image.isNull():
+        respond({"ok": False, "error": f"Could not load the image {path}"})
+        return
+    preset = request.get("preset", "explain")
+    prompt = request.get("prompt") or PROMPT_PRESETS.get(preset, "")
+    if not prompt:
+        respond({"ok": False, "error": "No prompt given"})
+        return
+
+    def on_done(reply, error):
+        if error is not None:
+            respond({"ok": False, "error": error})
+        else:
+            respond({"ok": True, "reply": reply})
+
+    get_window().submit_image(image, prompt, preset, on_done)
+
+
+def handle_stats(request, respond):
+    respond(
+        {
+            "ok": True,
+            "text": latency_stats(),
+            "metrics": get_window().metrics.summary(),
+            "model": dict(model.stats) if model is not None else None,
+        }
     )
-    text_cap.show()
 
-tray_icon = QSystemTrayIcon(QIcon(resource_path("clippy.png")))
-tray_icon.setToolTip("AI Snip tool")
 
-tray_menu = QMenu()
-show_action = QAction("AI Snip (CTRL + SHIFT + A)")
-response_action = QAction("Show AI response")
-text_write_action = QAction("Show text input")
-quit_action = QAction("Quit")
-show_action.triggered.connect(window.showFullScreen)
-response_action.triggered.connect(speech_bubble.show)
-text_write_action.triggered.connect(text_widget.show)
-quit_action.triggered.connect(app.quit)
+def show_past_reply(reply):
+    # From the history, no request needed
+    bubble = get_speech_bubble()
+    bubble.reset(reply, animate=False)
+    bubble.show()
+
+
+def history_label(row):
+    created = datetime.fromtimestamp(row["created"]).strftime("%d.%m. %H:%M")
+    text = " ".join(row["reply"].split())
+    if len(text) > 50:
+        text = text[:49] + "…"
+    # A single & would mark a keyboard shortcut
+    return f"{created}  {text}".replace("&", "&&")
+
+
+def fill_history_menu(menu, rows):
+    menu.clear()
+    for row in rows:
+        action = menu.addAction(history_label(row))
+        action.triggered.connect(
+            lambda checked=False, reply=row["reply"]: show_past_reply(reply)
+        )
+    if not rows:
+        menu.addAction("No snips yet").setEnabled(False)
+
+
+def update_history_menu():
+    fill_history_menu(history_menu, history.recent(10))
+    history_menu.addSeparator()
+    history_menu.addAction("Search...").triggered.connect(search_history)
+
+
+def search_history():
+    query, ok = QInputDialog.getText(None, "AI Snip", "Search past replies:")
+    if not ok or not query.strip():
+        return
+    rows = history.search(query)
+    if not rows:
+        show_past_reply(f"Nothing found for {query!r}")
+        return
+    fill_history_menu(search_menu, rows)
+    search_menu.popup(QCursor.pos())
+
+
+def shutdown():
+    ipc_server.close()
+    if _window is not None:
+        _window.archive_writer.close()
+    close_http_client()
+    history.close()
+
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    app.setQuitOnLastWindowClosed(False)
+
+    ipc_server = IpcServer(
+        {"snip": handle_snip, "ask": handle_ask, "stats": handle_stats}
+    )
+    if not ipc_server.listen():
+        # Started at the same time as another instance, hand the snip over to it
+        client.run_or_forward()
+
+    response_cache = ResponseCache()
+    history = HistoryStore()
+    retention_timer = QTimer()
+    model = None
+    router = None
+    text_cap = None
+
+    tray_icon = QSystemTrayIcon(QIcon(resource_path("clippy.png")))
+    tray_icon.setToolTip("AI Snip tool")
 
-tray_menu.addAction(show_action)
-tray_menu.addAction(response_action)
-tray_menu.addAction(quit_action)
-tray_icon.setContextMenu(tray_menu)
+    tray_menu = QMenu()
+    show_action = QAction("AI Snip (CTRL + SHIFT + A)")
+    response_action = QAction("Show AI response")
+    text_write_action = QAction("Show text input")
+    cancel_action = QAction("Cancel AI request")
+    stop_watch_action = QAction("Stop watching region")
+    stats_action = QAction("Latency stats")
+    quit_action = QAction("Quit")
+    show_action.triggered.connect(lambda: get_window().showFullScreen())
+    response_action.triggered.connect(lambda: get_speech_bubble().show())
+    text_write_action.triggered.connect(lambda: get_text_widget().show())
+    cancel_action.triggered.connect(lambda: get_window().cancel_completion())
+    stop_watch_action.triggered.connect(lambda: get_window().stop_watch())
+    stats_action.triggered.connect(show_latency_stats)
+    quit_action.triggered.connect(app.quit)
+    app.aboutToQuit.connect(shutdown)
 
-tray_icon.show()
+    tray_menu.addAction(show_action)
+    tray_menu.addAction(response_action)
+    tray_menu.addAction(cancel_action)
+    tray_menu.addAction(stop_watch_action)
+    # Filled from the history store whenever it is opened
+    history_menu = tray_menu.addMenu("History")
+    history_menu.aboutToShow.connect(update_history_menu)
+    search_menu = QMenu()
+    tray_menu.addAction(stats_action)
+    tray_menu.addAction(quit_action)
+    tray_icon.setContextMenu(tray_menu)
 
-keyboard.add_hotkey("CTRL + SHIFT + A", show_action.trigger)
+    tray_icon.show()
+    if os.environ.get("AISNIP_EXIT_AFTER_STARTUP"):
+        print(f"tray_ms={(time.perf_counter() - STARTUP_TIME) * 1000:.1f}")
 
-window.showFullScreen()
-window.close()
+    QTimer.singleShot(0, finish_startup)
 
-sys.exit(app.exec())
+    sys.exit(app.exec())
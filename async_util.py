@@ -0,0 +1,386 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import re
+import time
+from typing import Callable, Optional
+
+from util import ModelWrapper
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Fails requests immediately after too many consecutive failures. After the
+    # cooldown requests are let through again, the next failure re-opens it.
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        remaining = self.cooldown - (time.monotonic() - self.opened_at)
+        if remaining > 0:
+            raise CircuitOpenError(
+                f"Endpoint is failing, not sending requests for {remaining:.1f}s"
+            )
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+def parse_duration(value: str) -> float:
+    # Reset times in the rate limit headers look like "20ms", "1s" or "6m0s"
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(
+        float(amount) * units[unit]
+        for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    )
+
+
+class TokenBucket:
+    # Refilling budget of requests or tokens. Capacity and refill rate are taken
+    # from the x-ratelimit-* headers, until the first response it does not limit.
+    def __init__(self):
+        self.capacity = None
+        self.level = 0.0
+        self.rate = None
+        self.updated = time.monotonic()
+
+    def update(self, limit: int, remaining: int, reset_seconds: float):
+        self.capacity = limit
+        self.level = remaining
+        # The used part of the budget is restored within reset_seconds
+        self.rate = max(limit - remaining, 1) / max(reset_seconds, 0.001)
+        self.updated = time.monotonic()
+
+    def reserve(self, cost: float) -> float:
+        # Takes cost from the bucket and returns how long to wait until it is
+        # actually available. The level can go negative, so concurrent callers
+        # queue up behind each other.
+        if self.capacity is None:
+            return 0.0
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= cost
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+
+def estimate_request_tokens(messages: list[dict]) -> int:
+    # Rough input token count used for pacing, about 4 characters per token and
+    # the cost of a medium sized image for every image part
+    tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        for part in content:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 4
+            else:
+                tokens += 765
+    return tokens
+
+
+class AsyncModelWrapper(ModelWrapper):
+    # asyncio counterpart of ModelWrapper. Requests are limited in concurrency,
+    # paced by the rate limit headers, retried with jittered exponential backoff
+    # and bounded by a deadline. The stats, cost and cache helpers are those of
+    # ModelWrapper, the methods that make requests are coroutines here.
+    def __init__(
+        self,
+        client,
+        model_name: str,
+        log_file: Optional[str] = None,
+        cache=None,
+        max_concurrency: int = 4,
+        max_retries: int = 4,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+        deadline: float = 60.0,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+    ):
+        super().__init__(client, model_name, log_file, cache)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.request_bucket = TokenBucket()
+        self.token_bucket = TokenBucket()
+
+    def with_model(self, model_name: str) -> AsyncModelWrapper:
+        # Another model on the same client, cache and log, with its own stats
+        # and rate limits. The concurrency limit and circuit breaker are those of
+        # the endpoint, so they are shared.
+        model = AsyncModelWrapper(
+            self.client,
+            model_name,
+            cache=self.cache,
+            max_retries=self.max_retries,
+            backoff_base=self.backoff_base,
+            backoff_max=self.backoff_max,
+            deadline=self.deadline,
+            circuit_breaker=self.circuit_breaker,
+        )
+        model.semaphore = self.semaphore
+        model.log_file = self.log_file
+        model.logger = self.logger
+        return model
+
+    async def prewarm(self, min_interval: float = 60.0):
+        # Opens a connection to the API host, see ModelWrapper.prewarm
+        now = time.monotonic()
+        if now - self.last_prewarm < min_interval:
+            return
+        self.last_prewarm = now
+
+        import httpx
+
+        try:
+            await self.client._client.head(str(self.client.base_url), timeout=10.0)
+        except httpx.HTTPError:
+            pass
+
+    async def stream_complete(self, messages: list[dict[str, str]], **kwargs):
+        # The deltas of the reply as an async iterator, with the limits, retries
+        # and deadline of complete
+        deltas = asyncio.Queue()
+        task = asyncio.ensure_future(
+            self.complete(messages, stream=True, callback=deltas.put_nowait, **kwargs)
+        )
+        task.add_done_callback(lambda _: deltas.put_nowait(None))
+        try:
+            while True:
+                delta = await deltas.get()
+                if delta is None:
+                    break
+                yield delta
+            # Raises the error of the request, if any
+            await task
+        finally:
+            # Closing the iterator early aborts the request
+            task.cancel()
+
+    async def structured_complete(
+        self,
+        messages: list[dict[str, str]],
+        structure_class,
+        cache_key: Optional[str] = None,
+        **kwargs,
+    ):
+        # See ModelWrapper.structured_complete, not retried
+        from openai.types.chat import ParsedChatCompletionMessage
+
+        if cache_key is not None:
+            cached = self.cache_get(cache_key)
+            if cached is not None:
+                return ParsedChatCompletionMessage[
+                    structure_class
+                ].model_validate_json(cached)
+
+        self.circuit_breaker.check()
+        async with self.semaphore:
+            await self.pace(messages)
+            start = time.perf_counter()
+            response = await self.client.beta.chat.completions.parse(
+                model=self.model_name,
+                messages=messages,
+                response_format=structure_class,
+                **kwargs,
+            )
+        self.record_usage(response.usage)
+        self.log(messages, response.choices[0].message.dict(), start, response.usage)
+
+        if cache_key is not None:
+            self.cache_put(cache_key, response.choices[0].message.model_dump_json())
+        return response.choices[0].message
+
+    async def complete(
+        self,
+        messages: list[dict[str, str]],
+        stream: bool = False,
+        callback: Optional[Callable[[str], None]] = None,
+        cache_key: Optional[str] = None,
+        deadline: Optional[float] = None,
+        **kwargs,
+    ) -> str:
+        if cache_key is not None:
+            reply = self.cache_get(cache_key)
+            if reply is not None:
+                if callback is not None:
+                    callback(reply)
+                return reply
+
+        self.circuit_breaker.check()
+        try:
+            # The deadline includes waiting for a slot, pacing and retries
+            reply = await asyncio.wait_for(
+                self.complete_with_retries(messages, stream, callback, kwargs),
+                deadline or self.deadline,
+            )
+        except asyncio.TimeoutError:
+            self.count("deadline_exceeded")
+            self.circuit_breaker.record_failure()
+            raise
+
+        if cache_key is not None:
+            self.cache_put(cache_key, reply)
+        return reply
+
+    async def complete_with_retries(self, messages, stream, callback, kwargs) -> str:
+        import openai
+
+        retryable = (
+            openai.RateLimitError,
+            openai.APITimeoutError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+        )
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.pace(messages)
+                try:
+                    reply = await self.request(messages, stream, callback, kwargs)
+                except retryable as e:
+                    if isinstance(e, openai.RateLimitError):
+                        # Not a degraded endpoint, pacing and backoff handle it
+                        self.count("rate_limited")
+                    else:
+                        self.circuit_breaker.record_failure()
+                    if attempt == self.max_retries:
+                        raise
+                    # Fail fast instead of retrying against a degraded endpoint
+                    self.circuit_breaker.check()
+                    self.count("retries")
+                    await asyncio.sleep(self.backoff(attempt, e))
+                else:
+                    self.circuit_breaker.record_success()
+                    return reply
+
+    async def pace(self, messages):
+        delay = max(
+            self.request_bucket.reserve(1),
+            self.token_bucket.reserve(estimate_request_tokens(messages)),
+        )
+        if delay > 0:
+            self.count("paced_seconds", delay)
+            await asyncio.sleep(delay)
+
+    def backoff(self, attempt: int, error) -> float:
+        # Honor the server's retry-after, otherwise use "full jitter" backoff
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after-ms")
+            if retry_after is not None:
+                return float(retry_after) / 1000
+            retry_after = response.headers.get("retry-after")
+            if retry_after is not None and retry_after.replace(".", "").isdigit():
+                return float(retry_after)
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2**attempt)
+        )
+
+    def update_rate_limits(self, headers):
+        for bucket, kind in (
+            (self.request_bucket, "requests"),
+            (self.token_bucket, "tokens"),
+        ):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = headers.get(f"x-ratelimit-reset-{kind}")
+            if limit and remaining and reset:
+                bucket.update(int(limit), int(remaining), parse_duration(reset))
+
+    async def request(self, messages, stream, callback, kwargs) -> str:
+        kwargs = dict(kwargs)
+        on_send = kwargs.pop("on_send", None)
+        if on_send is not None:
+            on_send()
+        if stream:
+            kwargs = {"stream_options": {"include_usage": True}, **kwargs}
+        start = time.perf_counter()
+        raw = await self.client.chat.completions.with_raw_response.create(
+            model=self.model_name, messages=messages, stream=stream, **kwargs
+        )
+        self.update_rate_limits(raw.headers)
+        response = raw.parse()
+
+        if not stream:
+            self.record_usage(response.usage)
+            self.log(
+                messages, response.choices[0].message.dict(), start, response.usage
+            )
+            return response.choices[0].message.content
+
+        parts = []
+        usage = first_token = None
+        try:
+            async for chunk in response:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                    self.record_usage(usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    parts.append(chunk.choices[0].delta.content)
+                    if callback is not None:
+                        callback(chunk.choices[0].delta.content)
+        finally:
+            await response.close()
+        self.log(
+            messages,
+            {"role": "assistant", "content": "".join(parts)},
+            start,
+            usage,
+            first_token_s=first_token,
+        )
+        return "".join(parts)
+
+
+class AsyncOpenAIModelWrapper(AsyncModelWrapper):
+    def __init__(
+        self,
+        model_name: str = "gpt-4o",
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        base_url: Optional[str] = None,
+        **kwargs,
+    ):
+        from openai import AsyncOpenAI
+
+        # Retries are done by the wrapper, with backoff and the circuit breaker
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        super().__init__(client, model_name, **kwargs)
+
+
+class AsyncAzureModelWrapper(AsyncModelWrapper):
+    def __init__(
+        self,
+        model_name: str = "gpt-4o",
+        api_version="2024-08-01-preview",
+        **kwargs,
+    ):
+        from openai import AsyncAzureOpenAI
+
+        client = AsyncAzureOpenAI(
+            api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
+            api_version=api_version,
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            max_retries=0,
+        )
+        super().__init__(client, model_name, **kwargs)
@@ -0,0 +1,132 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from util import PROMPT_PRESETS, local_image_to_data_url, model_from_env
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+
+def find_images(source: str) -> list[str]:
+    # A directory means all images in it, anything else is used as a glob
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(os.path.expanduser(source), recursive=True)
+    return sorted(p for p in paths if p.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def load_done(output_path: str) -> set[tuple[str, str]]:
+    # Images that already have a result for a prompt, so that an interrupted run
+    # can be resumed
+    done = set()
+    if not os.path.isfile(output_path):
+        return done
+    with open(output_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Partially written last line of an interrupted run
+            if entry.get("error") is None:
+                done.add((entry["path"], entry["prompt"]))
+    return done
+
+
+def process_image(model, image_path: str, prompt: str) -> dict:
+    start = time.perf_counter()
+    entry = {"path": image_path, "prompt": prompt, "model": model.model_name}
+    try:
+        # Unreadable files are recorded as errors like failed requests
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": local_image_to_data_url(image_path)},
+                    },
+                ],
+            }
+        ]
+        entry["reply"] = model.complete(messages)
+        entry["error"] = None
+    except Exception as e:
+        entry["reply"] = None
+        entry["error"] = str(e)
+    entry["latency_s"] = round(time.perf_counter() - start, 3)
+    return entry
+
+
+def run_batch(model, image_paths, prompt, output_path, concurrency):
+    done = load_done(output_path)
+    todo = [p for p in image_paths if (os.path.abspath(p), prompt) not in done]
+    print(f"{len(todo)} images to process, {len(image_paths) - len(todo)} done")
+
+    start = time.perf_counter()
+    failed = 0
+    with open(output_path, "a") as out, ThreadPoolExecutor(concurrency) as pool:
+        futures = [
+            pool.submit(process_image, model, os.path.abspath(p), prompt)
+            for p in todo
+        ]
+        try:
+            for i, future in enumerate(as_completed(futures), 1):
+                entry = future.result()
+                failed += entry["error"] is not None
+                # One flushed line per result, so an interruption loses nothing
+                out.write(json.dumps(entry) + "\n")
+                out.flush()
+                print(f"[{i}/{len(todo)}] {entry['path']}", file=sys.stderr)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            print("Interrupted, run again to resume", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    print(f"Processed {len(todo)} images in {elapsed:.1f}s, {failed} failed")
+    if elapsed > 0:
+        print(f"Throughput: {len(todo) / elapsed:.2f} images/s")
+    print(
+        f"Requests: {model.stats['requests']}, input tokens: "
+        f"{model.stats['input_tokens']}, completion tokens: "
+        f"{model.stats['completion_tokens']}"
+    )
+    try:
+        print(f"Cost: ${model.compute_cost():.4f}")
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run an AI Snip prompt over a directory of images"
+    )
+    parser.add_argument("source", help="Directory or glob of images")
+    parser.add_argument(
+        "--preset",
+        choices=[name for name, prompt in PROMPT_PRESETS.items() if prompt],
+        default="explain",
+    )
+    parser.add_argument("--prompt", help="Custom prompt, overrides --preset")
+    parser.add_argument("--output", default="aisnip_results.jsonl")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--model", default="gpt-4o")
+    args = parser.parse_args()
+
+    model = model_from_env(model_name=args.model)
+    if model is None:
+        sys.exit("No API key, set OPENAI_API_KEY or AZURE_OPENAI_API_KEY")
+
+    run_batch(
+        model,
+        find_images(args.source),
+        args.prompt or PROMPT_PRESETS[args.preset],
+        args.output,
+        args.concurrency,
+    )
@@ -0,0 +1,529 @@
+import argparse
+import base64
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from util import image_bytes_to_data_url, local_image_to_data_url
+
+
+def time_it(fn, repeats: int) -> dict:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    # Peak of the additional memory allocated by one run
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "min_ms": min(times),
+        "median_ms": statistics.median(times),
+        "peak_mb": peak / 1024 / 1024,
+    }
+
+
+def bench_data_url(size_mb: float, repeats: int) -> dict:
+    # Random bytes do not compress, so they stand in for a large PNG grab
+    data = os.urandom(int(size_mb * 1024 * 1024))
+    tmp_dir = tempfile.mkdtemp()
+    file_path = os.path.join(tmp_dir, "snip.png")
+
+    def disk_path():
+        # What capture used to do: write the PNG, read it back and encode it
+        with open(file_path, "wb") as f:
+            f.write(data)
+        local_image_to_data_url(file_path)
+
+    def memory_path():
+        image_bytes_to_data_url(data, "image/png")
+
+    expected = "data:image/png;base64," + base64.b64encode(data).decode("ascii")
+    assert image_bytes_to_data_url(data, "image/png") == expected
+    results = {
+        "size_mb": size_mb,
+        "disk": time_it(disk_path, repeats),
+        "memory": time_it(memory_path, repeats),
+    }
+    os.remove(file_path)
+    os.rmdir(tmp_dir)
+    return results
+
+
+def naive_wrap(text: str, metrics, max_width: int) -> list[str]:
+    # The word wrapping the speech bubble did on every frame before TextLayout
+    words = [x for x in text.replace("\n", " \n ").split(" ") if x]
+    lines = []
+    current_line = ""
+    for word in words:
+        test_line = current_line + " " + word if current_line else word
+        if word == "\n":
+            lines.append(current_line)
+            current_line = ""
+        elif metrics.horizontalAdvance(test_line) > max_width:
+            lines.append(current_line)
+            current_line = word
+        else:
+            current_line = test_line
+    if current_line:
+        lines.append(current_line)
+    return lines
+
+
+def long_reply(length: int) -> str:
+    words = "Lorem ipsum dolor sit amet consectetur adipiscing elit sed do".split()
+    text = []
+    while sum(len(w) + 1 for w in text) < length:
+        text.append(words[len(text) % len(words)])
+        if len(text) % 40 == 0:
+            text.append("\n")
+    return " ".join(text)[:length]
+
+
+def qt_app():
+    # Benchmarks that need Qt run headless
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+
+    return QApplication.instance() or QApplication([])
+
+
+def bench_layout(length: int, paint_samples: int) -> dict:
+    app = qt_app()
+    from speech_bubble import SpeechBubbleWidget, TextLayout
+
+    text = long_reply(length)
+    bubble = SpeechBubbleWidget()
+    bubble.reset(text)
+    bubble.timer.stop()
+    max_width = bubble.width() - 60
+
+    def naive_reveal():
+        # Per frame: wrap the revealed text and the full text
+        for i in range(0, len(text) + 1):
+            naive_wrap(text[:i], bubble.metrics, max_width)
+            naive_wrap(text, bubble.metrics, max_width)
+
+    def layout_reveal():
+        layout = TextLayout(bubble.metrics)
+        for i in range(0, len(text) + 1):
+            layout.set_text(text, max_width)
+            layout.visible_lines(i)
+
+    def streamed_layout_reveal():
+        # Text arriving a few characters at a time while being revealed
+        layout = TextLayout(bubble.metrics)
+        for i in range(0, len(text) + 1):
+            layout.set_text(text[: i + 20], max_width)
+            layout.visible_lines(i)
+
+    def paint():
+        # Full repaints at evenly spaced points of the animation
+        for i in range(paint_samples):
+            bubble.char_index = len(text) * (i + 1) // paint_samples
+            bubble.grab()
+
+    results = {
+        "chars": len(text),
+        "naive_reveal": time_it(naive_reveal, 1),
+        "layout_reveal": time_it(layout_reveal, 1),
+        "streamed_layout_reveal": time_it(streamed_layout_reveal, 1),
+        "paint": time_it(paint, 1),
+    }
+    results["paint"]["per_frame_ms"] = results["paint"]["min_ms"] / paint_samples
+    app.processEvents()
+    return results
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def bench_overlay(width: int, height: int, steps: int) -> dict:
+    # Drag a selection across the snipping overlay and record every paintEvent
+    app = qt_app()
+    from PyQt6.QtCore import QEvent, QPointF, Qt
+    from PyQt6.QtGui import QMouseEvent
+    from PyQt6.QtWidgets import QApplication
+    from aisnip import SnippingTool
+
+    tool = SnippingTool(None)
+    tool.setGeometry(0, 0, width, height)
+    tool.show()
+    app.processEvents()
+
+    frame_times = []
+    painted_pixels = []
+
+    def record(ms, rect):
+        frame_times.append(ms)
+        painted_pixels.append(rect.width() * rect.height())
+
+    tool.frame_time_hook = record
+
+    def mouse_event(event_type, x, y):
+        pos = QPointF(x, y)
+        event = QMouseEvent(
+            event_type,
+            pos,
+            pos,
+            Qt.MouseButton.LeftButton,
+            Qt.MouseButton.LeftButton,
+            Qt.KeyboardModifier.NoModifier,
+        )
+        QApplication.sendEvent(tool, event)
+        app.processEvents()
+
+    start = time.perf_counter()
+    mouse_event(QEvent.Type.MouseButtonPress, width // 10, height // 10)
+    for i in range(1, steps + 1):
+        mouse_event(
+            QEvent.Type.MouseMove,
+            width // 10 + i * width * 0.8 / steps,
+            height // 10 + i * height * 0.8 / steps,
+        )
+    total_ms = (time.perf_counter() - start) * 1000
+    tool.frame_time_hook = None
+    tool.close()
+
+    return {
+        "resolution": f"{width}x{height}",
+        "frames": len(frame_times),
+        "frame_ms": {
+            "p50": percentile(frame_times, 0.5),
+            "p95": percentile(frame_times, 0.95),
+            "max": max(frame_times),
+        },
+        "painted_fraction": sum(painted_pixels)
+        / (len(painted_pixels) * width * height),
+        "drag_ms": total_ms,
+    }
+
+
+def test_pattern(width: int, height: int):
+    # Stands in for a screen: text on a light background with a colored panel
+    from PyQt6.QtCore import QRect, Qt
+    from PyQt6.QtGui import QColor, QLinearGradient, QPainter, QPixmap
+
+    frame = QPixmap(width, height)
+    frame.fill(QColor(245, 245, 245))
+    painter = QPainter(frame)
+    gradient = QLinearGradient(0, 0, width, height)
+    gradient.setColorAt(0, QColor(40, 90, 160))
+    gradient.setColorAt(1, QColor(200, 120, 40))
+    painter.fillRect(QRect(width // 2, 0, width // 2, height // 3), gradient)
+    painter.setPen(Qt.GlobalColor.black)
+    text = long_reply(200)
+    for y in range(20, height, 18):
+        painter.drawText(10, y, text)
+    painter.end()
+    return frame
+
+
+def bench_capture(width: int, height: int, repeats: int) -> dict:
+    # Crop of a selection from the frozen frame, then preparing it for upload
+    app = qt_app()
+    from PyQt6.QtCore import QPoint
+    from aisnip import SnippingTool
+    from imaging import PreprocessPolicy, image_to_bytes, preprocess_image
+
+    tool = SnippingTool(None)
+    tool.frozen_frame = test_pattern(width, height)
+    tool.begin, tool.end = QPoint(0, 0), QPoint(width, height)
+    image = tool.capture()
+    policy = PreprocessPolicy()
+
+    def encode():
+        data, mime_type, _, _ = preprocess_image(image, policy)
+        image_bytes_to_data_url(data, mime_type)
+
+    tmp_dir = tempfile.mkdtemp()
+    file_path = os.path.join(tmp_dir, "snip.png")
+    with open(file_path, "wb") as f:
+        f.write(image_to_bytes(image))
+
+    results = {
+        "resolution": f"{width}x{height}",
+        "capture": time_it(tool.capture, repeats),
+        "encode": time_it(encode, repeats),
+        "png_file_data_url": time_it(
+            lambda: local_image_to_data_url(file_path), repeats
+        ),
+    }
+    seconds = (results["capture"]["median_ms"] + results["encode"]["median_ms"]) / 1000
+    results["megapixels_per_s"] = width * height / 1e6 / seconds
+    os.remove(file_path)
+    os.rmdir(tmp_dir)
+    app.processEvents()
+    return results
+
+
+def bench_model(repeats: int, reply_words: int) -> dict:
+    # Time spent in ModelWrapper and the SDK on top of the plain HTTP request
+    from mock_server import MockServer
+    from util import OpenAIModelWrapper, get_http_client
+
+    server = MockServer(reply=long_reply(reply_words * 6)).start()
+    model = OpenAIModelWrapper(api_key="mock", base_url=server.base_url)
+    client = get_http_client()
+    url = server.base_url + "/chat/completions"
+    messages = [{"role": "user", "content": "Hello"}]
+    body = {"model": model.model_name, "messages": messages}
+
+    def raw():
+        client.post(url, json=body).json()
+
+    def raw_stream():
+        stream_body = {**body, "stream": True}
+        with client.stream("POST", url, json=stream_body) as response:
+            for line in response.iter_lines():
+                if line.startswith("data: {"):
+                    json.loads(line[len("data: ") :])
+
+    results = {
+        "raw": time_it(raw, repeats),
+        "wrapper": time_it(lambda: model.complete(messages), repeats),
+        "raw_stream": time_it(raw_stream, repeats),
+        "wrapper_stream": time_it(
+            lambda: model.complete(messages, stream=True, callback=lambda t: None),
+            repeats,
+        ),
+    }
+    results["overhead_ms"] = {
+        "complete": results["wrapper"]["median_ms"] - results["raw"]["median_ms"],
+        "stream": results["wrapper_stream"]["median_ms"]
+        - results["raw_stream"]["median_ms"],
+    }
+    server.shutdown()
+    return results
+
+
+def bench_end_to_end(runs: int, latency_ms: float, tokens_per_second: float) -> dict:
+    # Mouse release on the overlay until the first character is in the bubble,
+    # against the mock server
+    app = qt_app()
+    from PyQt6.QtCore import QEvent, QPointF, Qt
+    from PyQt6.QtGui import QMouseEvent
+    from PyQt6.QtWidgets import QApplication
+    import aisnip
+    from mock_server import MockServer
+    from util import OpenAIModelWrapper
+
+    server = MockServer(
+        reply=long_reply(600),
+        latency=latency_ms / 1000,
+        tokens_per_second=tokens_per_second,
+    ).start()
+    model = OpenAIModelWrapper(api_key="mock", base_url=server.base_url)
+    tool = aisnip._window = aisnip.SnippingTool(model)
+    tool.save_folder = tempfile.mkdtemp()
+
+    def mouse_event(event_type, x, y):
+        pos = QPointF(x, y)
+        event = QMouseEvent(
+            event_type,
+            pos,
+            pos,
+            Qt.MouseButton.LeftButton,
+            Qt.MouseButton.LeftButton,
+            Qt.KeyboardModifier.NoModifier,
+        )
+        QApplication.sendEvent(tool, event)
+
+    def wait_for(condition, timeout=30.0):
+        deadline = time.perf_counter() + timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                raise TimeoutError("The snip did not finish")
+            app.processEvents()
+            time.sleep(0.001)
+
+    first_token, first_char = [], []
+    for _ in range(runs):
+        tool.showFullScreen()
+        app.processEvents()
+        trace = tool.trace
+        mouse_event(QEvent.Type.MouseButtonPress, 50, 50)
+        mouse_event(QEvent.Type.MouseMove, 300, 200)
+        mouse_event(QEvent.Type.MouseButtonRelease, 300, 200)
+        wait_for(lambda: trace.has("first_char"))
+        release = trace.marks["selection"]
+        first_token.append((trace.marks["first_token"] - release) * 1000)
+        first_char.append((trace.marks["first_char"] - release) * 1000)
+        wait_for(lambda: tool.pending is None)
+        aisnip.get_speech_bubble().close()
+    tool.archive_writer.close()
+    server.shutdown()
+
+    return {
+        "runs": runs,
+        "server_latency_ms": latency_ms,
+        "tokens_per_second": tokens_per_second,
+        "release_to_first_token_ms": {
+            "p50": percentile(first_token, 0.5),
+            "p95": percentile(first_token, 0.95),
+            "max": max(first_token),
+        },
+        "release_to_first_char_ms": {
+            "p50": percentile(first_char, 0.5),
+            "p95": percentile(first_char, 0.95),
+            "max": max(first_char),
+        },
+    }
+
+
+def bench_startup(runs: int, top: int) -> dict:
+    # Start the app until it is ready and quit, with an import time breakdown
+    env = dict(
+        os.environ, QT_QPA_PLATFORM="offscreen", AISNIP_EXIT_AFTER_STARTUP="1"
+    )
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aisnip.py")
+    wall, tray, ready = [], [], []
+    imports = {}
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", script],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        wall.append((time.perf_counter() - start) * 1000)
+        for line in result.stdout.splitlines():
+            key, _, value = line.partition("=")
+            if key == "tray_ms":
+                tray.append(float(value))
+            elif key == "ready_ms":
+                ready.append(float(value))
+
+        # Lines look like "import time:  self [us] | cumulative | package", top
+        # level imports are not indented
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            _, cumulative, name = line[len("import time:") :].split("|")
+            if cumulative.strip().isdigit() and not name.startswith("  "):
+                imports.setdefault(name.strip(), []).append(int(cumulative) / 1000)
+
+    slowest = sorted(
+        ((statistics.median(ms), name) for name, ms in imports.items()), reverse=True
+    )
+    return {
+        "runs": runs,
+        "wall_ms": {"min": min(wall), "median": statistics.median(wall)},
+        "tray_ms": {"min": min(tray), "median": statistics.median(tray)},
+        "ready_ms": {"min": min(ready), "median": statistics.median(ready)},
+        "imports_ms": {name: ms for ms, name in slowest[:top]},
+    }
+
+
+def print_results(name: str, results: dict, as_json: bool = False):
+    if as_json:
+        # One line per result, for comparing runs in scripts
+        print(json.dumps({"benchmark": name, **results}))
+        return
+    print(f"{name}:")
+    for key, value in results.items():
+        if isinstance(value, dict):
+            timings = ", ".join(f"{k}={v:.2f}" for k, v in value.items())
+            print(f"  {key}: {timings}")
+        else:
+            print(f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AI Snip micro-benchmarks")
+    parser.add_argument(
+        "--json", action="store_true", help="Print the results as JSON lines"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    data_url_parser = subparsers.add_parser(
+        "data-url", help="Disk vs in-memory image to data URL"
+    )
+    data_url_parser.add_argument(
+        "--size-mb", type=float, nargs="+", default=[1, 8, 32]
+    )
+    data_url_parser.add_argument("--repeats", type=int, default=10)
+
+    layout_parser = subparsers.add_parser(
+        "layout", help="Speech bubble text layout over a long reply"
+    )
+    layout_parser.add_argument("--length", type=int, nargs="+", default=[500, 3000])
+    layout_parser.add_argument("--paint-samples", type=int, default=50)
+
+    overlay_parser = subparsers.add_parser(
+        "overlay", help="Frame times while dragging a selection on the overlay"
+    )
+    overlay_parser.add_argument(
+        "--resolution", nargs="+", default=["1920x1080", "3840x2160", "7680x2160"]
+    )
+    overlay_parser.add_argument("--steps", type=int, default=200)
+
+    capture_parser = subparsers.add_parser(
+        "capture", help="Cropping a snip from the frozen frame and encoding it"
+    )
+    capture_parser.add_argument(
+        "--resolution", nargs="+", default=["640x480", "1920x1080", "3840x2160"]
+    )
+    capture_parser.add_argument("--repeats", type=int, default=10)
+
+    model_parser = subparsers.add_parser(
+        "model", help="ModelWrapper overhead against the mock server"
+    )
+    model_parser.add_argument("--repeats", type=int, default=50)
+    model_parser.add_argument("--reply-words", type=int, default=100)
+
+    end_to_end_parser = subparsers.add_parser(
+        "end-to-end", help="Mouse release to the first character of the reply"
+    )
+    end_to_end_parser.add_argument("--runs", type=int, default=10)
+    end_to_end_parser.add_argument("--latency-ms", type=float, default=300.0)
+    end_to_end_parser.add_argument("--tokens-per-second", type=float, default=50.0)
+
+    startup_parser = subparsers.add_parser(
+        "startup", help="Wall clock and import times of the app startup"
+    )
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--top", type=int, default=15)
+
+    args = parser.parse_args()
+    if args.benchmark == "data-url":
+        for size_mb in args.size_mb:
+            print_results("data-url", bench_data_url(size_mb, args.repeats), args.json)
+    elif args.benchmark == "layout":
+        for length in args.length:
+            print_results(
+                "layout", bench_layout(length, args.paint_samples), args.json
+            )
+    elif args.benchmark == "overlay":
+        for resolution in args.resolution:
+            width, height = map(int, resolution.split("x"))
+            print_results(
+                "overlay", bench_overlay(width, height, args.steps), args.json
+            )
+    elif args.benchmark == "capture":
+        for resolution in args.resolution:
+            width, height = map(int, resolution.split("x"))
+            print_results(
+                "capture", bench_capture(width, height, args.repeats), args.json
+            )
+    elif args.benchmark == "model":
+        print_results("model", bench_model(args.repeats, args.reply_words), args.json)
+    elif args.benchmark == "end-to-end":
+        print_results(
+            "end-to-end",
+            bench_end_to_end(args.runs, args.latency_ms, args.tokens_per_second),
+            args.json,
+        )
+    elif args.benchmark == "startup":
+        print_results("startup", bench_startup(args.runs, args.top), args.json)
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from util import DATA_DIR
+
+
+def make_cache_key(image_hash: str, prompt: str, model_name: str) -> str:
+    return hashlib.sha256(f"{image_hash}\0{prompt}\0{model_name}".encode()).hexdigest()
+
+
+class ResponseCache:
+    # Two tier cache of model replies: a small in-memory LRU in front of a
+    # directory of JSON files with size based eviction. Both tiers expire
+    # entries after ttl seconds.
+    def __init__(
+        self,
+        cache_dir: str = os.path.join(DATA_DIR, "cache"),
+        memory_entries: int = 128,
+        max_disk_bytes: int = 50 * 1024 * 1024,
+        ttl: float = 7 * 24 * 3600,
+    ):
+        self.cache_dir = cache_dir
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        # Replies are stored from worker threads and read from the GUI thread
+        self.lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.disk_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(self.cache_dir)
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                created, value = self.memory[key]
+                if now - created < self.ttl:
+                    self.memory.move_to_end(key)
+                    return value
+                del self.memory[key]
+
+            path = self.entry_path(key)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+            if now - entry["created"] >= self.ttl:
+                self.remove_file(path)
+                return None
+            self.remember(key, entry["created"], entry["value"])
+            return entry["value"]
+
+    def put(self, key: str, value: str):
+        created = time.time()
+        with self.lock:
+            self.remember(key, created, value)
+            path = self.entry_path(key)
+            self.remove_file(path)
+            with open(path, "w") as f:
+                json.dump({"created": created, "value": value}, f)
+            self.disk_bytes += os.path.getsize(path)
+            if self.disk_bytes > self.max_disk_bytes:
+                self.evict()
+
+    def remember(self, key: str, created: float, value: str):
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        # Delete the oldest files until the disk tier is below 90% of its limit
+        entries = sorted(os.scandir(self.cache_dir), key=lambda e: e.stat().st_mtime)
+        for entry in entries:
+            if self.disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            self.remove_file(entry.path)
+
+    def remove_file(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.disk_bytes -= size
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
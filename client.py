@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import sys
+
+from ipc import NotRunning, forward_to_running, send_request
+from util import PROMPT_PRESETS
+
+# Command line client of the running AI Snip, usually through aisnip.py, e.g.
+#   python aisnip.py snip
+#   python aisnip.py ask screenshot.png --preset translate
+#   python aisnip.py stats
+
+
+COMMANDS = ("snip", "ask", "stats")
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="aisnip", description="Control the running AI Snip"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("snip", help="Open the snipping overlay")
+    ask = commands.add_parser("ask", help="Ask about an image file")
+    ask.add_argument("image")
+    ask.add_argument("-p", "--prompt", help="Defaults to the prompt of the preset")
+    ask.add_argument(
+        "--preset",
+        default="explain",
+        choices=[name for name, prompt in PROMPT_PRESETS.items() if prompt],
+    )
+    stats = commands.add_parser("stats", help="Show the latency and usage stats")
+    stats.add_argument("--json", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str]) -> int:
+    args = parse_args(argv)
+    request = {"command": args.command}
+    timeout = 5.0
+    if args.command == "ask":
+        request.update(
+            image=os.path.abspath(args.image), prompt=args.prompt, preset=args.preset
+        )
+        timeout = None  # As long as the model takes
+    try:
+        response = send_request(request, timeout=timeout)
+    except NotRunning:
+        print("AI Snip is not running, start it with python aisnip.py", file=sys.stderr)
+        return 1
+    if not response.get("ok"):
+        print(response.get("error", "Request failed"), file=sys.stderr)
+        return 1
+
+    if args.command == "ask":
+        print(response["reply"])
+    elif args.command == "stats":
+        if args.json:
+            print(json.dumps(response, indent=2))
+        else:
+            print(response["text"])
+    return 0
+
+
+def run_or_forward():
+    # Exits if the arguments are a client command or another instance took the
+    # snip, returns if this process is to start AI Snip
+    # Other arguments, like Qt's -platform, are for starting AI Snip
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(main(sys.argv[1:]))
+    # The startup benchmark needs a process of its own
+    if not os.environ.get("AISNIP_EXIT_AFTER_STARTUP") and forward_to_running(
+        {"command": "snip"}
+    ):
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,223 @@
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Iterator, Optional
+
+from util import ModelWrapper
+
+
+class AttemptCancelled(Exception):
+    pass
+
+
+class Attempt:
+    # One request to one backend on its own thread. Its tokens, result or error
+    # are put on the shared events queue as (attempt, kind, value).
+    def __init__(self, model: ModelWrapper, messages, stream, kwargs, events):
+        self.model = model
+        self.events = events
+        self.cancelled = False
+        self.start = time.perf_counter()
+        self.thread = threading.Thread(
+            target=self.run, args=(messages, stream, kwargs), daemon=True
+        )
+        self.thread.start()
+
+    def run(self, messages, stream, kwargs):
+        try:
+            reply = self.model.request(messages, stream, self.on_token, kwargs)
+        except AttemptCancelled:
+            return
+        except Exception as e:
+            self.events.put((self, "error", e))
+            return
+        self.events.put((self, "done", (reply, self.model.last_usage())))
+
+    def on_token(self, token: str):
+        if self.cancelled:
+            # Unwinds the request, which closes the response stream
+            raise AttemptCancelled()
+        self.events.put((self, "token", token))
+
+    def cancel(self):
+        # A request that has not started streaming yet runs on until it does
+        self.cancelled = True
+
+
+class HedgedModelWrapper(ModelWrapper):
+    # Sends every request to the primary backend, and also to the secondary if
+    # the primary has not sent its first token after the hedge delay. The first
+    # backend to answer is used and the other one is cancelled. The hedge delay
+    # is the p95 of the primary's recent time to first token, so about one in
+    # twenty requests is hedged.
+    #
+    # stats are those of the answers that were used, the stats of the backends
+    # include the cancelled requests and compute_cost is their sum.
+    def __init__(
+        self,
+        primary: ModelWrapper,
+        secondary: ModelWrapper,
+        cache=None,
+        initial_delay: float = 2.0,
+        min_delay: float = 0.3,
+        max_delay: float = 10.0,
+        window: int = 50,
+    ):
+        super().__init__(None, primary.model_name, cache=cache)
+        self.primary = primary
+        self.secondary = secondary
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # Recent times to first token of the primary in seconds
+        self.first_token_times = deque(maxlen=window)
+
+    def hedge_delay(self) -> float:
+        with self.stats_lock:
+            times = sorted(self.first_token_times)
+        if len(times) < 10:
+            return self.initial_delay
+        p95 = times[min(len(times) - 1, int(0.95 * len(times)))]
+        return min(self.max_delay, max(self.min_delay, p95))
+
+    def record_first_token(self, seconds: float):
+        with self.stats_lock:
+            self.first_token_times.append(seconds)
+
+    def request(
+        self,
+        messages: list[dict[str, str]],
+        stream: bool,
+        callback: Optional[Callable[[str], None]],
+        kwargs: dict,
+    ) -> str:
+        self.local.usage = None
+        events = queue.Queue()
+        primary = Attempt(self.primary, messages, stream, kwargs, events)
+        attempts = [primary]
+        deadline = primary.start + self.hedge_delay()
+
+        def hedge():
+            attempts.append(Attempt(self.secondary, messages, stream, kwargs, events))
+
+        try:
+            # Wait for the first token or result of either backend
+            failed = 0
+            while True:
+                timeout = None
+                if len(attempts) == 1:
+                    timeout = max(0.0, deadline - time.perf_counter())
+                try:
+                    attempt, kind, value = events.get(timeout=timeout)
+                except queue.Empty:
+                    self.count("hedges")
+                    hedge()
+                    continue
+                if kind != "error":
+                    break
+                failed += 1
+                if failed == len(attempts) == 2:
+                    raise value
+                if len(attempts) == 1:
+                    # The primary failed before the hedge, fail over right away
+                    self.count("failovers")
+                    hedge()
+
+            winner = attempt
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.cancel()
+            elapsed = time.perf_counter() - primary.start
+            if winner is primary:
+                self.count("primary_wins")
+                self.record_first_token(elapsed)
+            else:
+                self.count("secondary_wins")
+                if failed == 0:
+                    # Lower bound of the primary's time to first token
+                    self.record_first_token(elapsed)
+
+            # Go on with the winner's stream only
+            while True:
+                if attempt is winner:
+                    if kind == "token":
+                        if callback is not None:
+                            callback(value)
+                    elif kind == "done":
+                        reply, usage = value
+                        if usage is not None:
+                            self.record_usage(usage)
+                        return reply
+                    else:
+                        raise value
+                attempt, kind, value = events.get()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def with_model(self, model_name: str) -> ModelWrapper:
+        return HedgedModelWrapper(
+            self.primary.with_model(model_name),
+            self.secondary.with_model(model_name),
+            cache=self.cache,
+            initial_delay=self.initial_delay,
+            min_delay=self.min_delay,
+            max_delay=self.max_delay,
+            window=self.first_token_times.maxlen,
+        )
+
+    def prewarm(self, min_interval: float = 60.0):
+        self.primary.prewarm(min_interval)
+        self.secondary.prewarm(min_interval)
+
+    def stream_complete(
+        self, messages: list[dict[str, str]], on_send=None, **kwargs
+    ) -> Iterator[str]:
+        return self.stream_request(messages, dict(kwargs, on_send=on_send))
+
+    def structured_complete(self, *args, **kwargs):
+        # Not hedged
+        return self.primary.structured_complete(*args, **kwargs)
+
+    def token_prices(self) -> tuple[float, float]:
+        return self.primary.token_prices()
+
+    def compute_cost(
+        self,
+        input_token_cost: Optional[float] = None,
+        output_token_cost: Optional[float] = None,
+    ) -> float:
+        return self.primary.compute_cost(
+            input_token_cost, output_token_cost
+        ) + self.secondary.compute_cost(input_token_cost, output_token_cost)
+
+    def backend_stats(self) -> dict[str, dict]:
+        stats = {}
+        for name, backend in (
+            ("primary", self.primary),
+            ("secondary", self.secondary),
+        ):
+            stats[name] = dict(backend.stats, model=backend.model_name)
+            try:
+                stats[name]["cost"] = backend.compute_cost()
+            except ValueError:
+                pass
+        return stats
+
+    def format(self) -> str:
+        lines = [
+            f"Hedging after {self.hedge_delay() * 1000:.0f}ms:"
+            f" {self.stats.get('hedges', 0)} hedged,"
+            f" {self.stats.get('failovers', 0)} failed over"
+        ]
+        for name, stats in self.backend_stats().items():
+            line = (
+                f"{name} ({stats['model']}): {self.stats.get(name + '_wins', 0)}"
+                f" won, {stats['input_tokens']} input and"
+                f" {stats['completion_tokens']} completion tokens"
+            )
+            if "cost" in stats:
+                line += f", ${stats['cost']:.4f}"
+            lines.append(line)
+        return "\n".join(lines)
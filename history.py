@@ -0,0 +1,189 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from util import DATA_DIR
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snips (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    image_path TEXT,
+    image_hash TEXT,
+    prompt TEXT,
+    model TEXT,
+    reply TEXT,
+    input_tokens INTEGER,
+    completion_tokens INTEGER,
+    latency_ms REAL
+);
+CREATE INDEX IF NOT EXISTS snips_created ON snips (created);
+CREATE INDEX IF NOT EXISTS snips_image_hash ON snips (image_hash);
+"""
+
+# Full text index over prompts and replies, kept in sync by triggers
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS snips_fts USING fts5(
+    prompt, reply, content='snips', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS snips_insert AFTER INSERT ON snips BEGIN
+    INSERT INTO snips_fts (rowid, prompt, reply)
+    VALUES (new.id, new.prompt, new.reply);
+END;
+CREATE TRIGGER IF NOT EXISTS snips_delete AFTER DELETE ON snips BEGIN
+    INSERT INTO snips_fts (snips_fts, rowid, prompt, reply)
+    VALUES ('delete', old.id, old.prompt, old.reply);
+END;
+"""
+
+
+class HistoryStore:
+    # Index of all snips with their prompt and reply. The retention policy deletes
+    # archived images once they are older than max_age_days or the archive grows
+    # beyond max_image_bytes. The text of a snip is kept, it is small.
+    def __init__(
+        self,
+        path: str = os.path.join(DATA_DIR, "history.sqlite3"),
+        max_image_bytes: int = 1024 * 1024 * 1024,
+        max_age_days: float = 180,
+    ):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_image_bytes = max_image_bytes
+        self.max_age_days = max_age_days
+        # Written from worker threads, read from the GUI thread
+        self.lock = threading.Lock()
+        # Retention runs periodically on a thread, at most once at a time
+        self.retention_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+            try:
+                self.conn.executescript(FTS_SCHEMA)
+                self.full_text = True
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5, search falls back to LIKE
+                self.full_text = False
+
+    def add(
+        self,
+        image_path: Optional[str],
+        image_hash: str,
+        prompt: str,
+        model: str,
+        reply: str,
+        input_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        latency_ms: Optional[float] = None,
+    ) -> int:
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO snips (created, image_path, image_hash, prompt, model,"
+                " reply, input_tokens, completion_tokens, latency_ms)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(),
+                    image_path,
+                    image_hash,
+                    prompt,
+                    model,
+                    reply,
+                    input_tokens,
+                    completion_tokens,
+                    latency_ms,
+                ),
+            )
+            return cursor.lastrowid
+
+    def get(self, snip_id: int) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM snips WHERE id = ?", (snip_id,)
+            ).fetchone()
+
+    def recent(self, limit: int = 10) -> list[sqlite3.Row]:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM snips ORDER BY created DESC LIMIT ?", (limit,)
+            ).fetchall()
+
+    def search(self, query: str, limit: int = 20) -> list[sqlite3.Row]:
+        with self.lock:
+            if self.full_text:
+                # Quote every term, so that user input is not parsed as FTS syntax
+                terms = " ".join(
+                    '"' + term.replace('"', '""') + '"' for term in query.split()
+                )
+                if not terms:
+                    return []
+                return self.conn.execute(
+                    "SELECT snips.* FROM snips_fts JOIN snips"
+                    " ON snips.id = snips_fts.rowid WHERE snips_fts MATCH ?"
+                    " ORDER BY rank LIMIT ?",
+                    (terms, limit),
+                ).fetchall()
+            pattern = f"%{query}%"
+            return self.conn.execute(
+                "SELECT * FROM snips WHERE reply LIKE ? OR prompt LIKE ?"
+                " ORDER BY created DESC LIMIT ?",
+                (pattern, pattern, limit),
+            ).fetchall()
+
+    def apply_retention(self) -> int:
+        # Returns the number of evicted rows
+        if not self.retention_lock.acquire(blocking=False):
+            return 0
+        try:
+            return self.evict_images()
+        finally:
+            self.retention_lock.release()
+
+    def evict_images(self) -> int:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, created, image_path FROM snips"
+                " WHERE image_path IS NOT NULL ORDER BY created DESC"
+            ).fetchall()
+        cutoff = time.time() - self.max_age_days * 24 * 3600
+        total = 0
+        evict = []
+        # Rows of a fan-out share their image, it is kept or deleted with the
+        # newest row referring to it and only counted once
+        evicted_paths = {}
+        # Newest first, everything after the size budget is used up goes
+        for row in rows:
+            path = row["image_path"]
+            if path in evicted_paths:
+                if evicted_paths[path]:
+                    evict.append(row["id"])
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                evicted_paths[path] = True
+                evict.append(row["id"])  # Already gone
+                continue
+            total += size
+            evicted_paths[path] = (
+                row["created"] < cutoff or total > self.max_image_bytes
+            )
+            if evicted_paths[path]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                evict.append(row["id"])
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE snips SET image_path = NULL WHERE id = ?",
+                [(snip_id,) for snip_id in evict],
+            )
+        return len(evict)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
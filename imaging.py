@@ -0,0 +1,169 @@
+import hashlib
+import threading
+
+from PyQt6.QtCore import QBuffer, QByteArray, QIODevice, Qt
+from PyQt6.QtGui import QImage, QImageWriter
+
+from util import image_bytes_to_data_url
+
+
+def image_to_bytes(image: QImage, fmt: str = "PNG", quality: int = -1) -> bytes:
+    # Encode into memory instead of going through a file on disk.
+    # QImage, unlike QPixmap, can be used outside of the GUI thread.
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+    image.save(buffer, fmt, quality)
+    buffer.close()
+    return data.data()
+
+
+def image_pixels(image: QImage) -> memoryview:
+    # One 32 bit integer per pixel, rows are not padded for 32 bit formats
+    image = image.convertToFormat(QImage.Format.Format_RGB32)
+    data = image.constBits().asstring(image.sizeInBytes())
+    return memoryview(data).cast("I")
+
+
+def color_ratio(image: QImage, sample_size: int = 64) -> float:
+    # Fraction of distinct (coarsely quantized) colors in a thumbnail. Text and UI
+    # screenshots use few colors, photographs and renderings use many.
+    thumb = image.scaled(
+        sample_size,
+        sample_size,
+        Qt.AspectRatioMode.IgnoreAspectRatio,
+        Qt.TransformationMode.FastTransformation,
+    )
+    pixels = image_pixels(thumb)
+    colors = {pixel & 0xF0F0F0 for pixel in pixels}
+    return len(colors) / len(pixels)
+
+
+def perceptual_hash(image: QImage, hash_size: int = 16) -> str:
+    # Difference hash: compares neighboring pixels of a small grayscale thumbnail,
+    # so re-snipping the same content gives the same hash despite small changes
+    # in the pixels. The size is included since the thumbnail loses it.
+    thumb = image.convertToFormat(QImage.Format.Format_Grayscale8).scaled(
+        hash_size + 1,
+        hash_size,
+        Qt.AspectRatioMode.IgnoreAspectRatio,
+        Qt.TransformationMode.SmoothTransformation,
+    )
+    # Rows of 8 bit images are padded to 4 bytes
+    data = thumb.constBits().asstring(thumb.sizeInBytes())
+    row_bytes = thumb.bytesPerLine()
+    bits = 0
+    for y in range(hash_size):
+        row = data[y * row_bytes : y * row_bytes + hash_size + 1]
+        for x in range(hash_size):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return f"{image.width()}x{image.height()}:{bits:0{hash_size * hash_size // 4}x}"
+
+
+def snip_hash(image: QImage) -> str:
+    # The perceptual hash, for finding near duplicates, followed by a hash of the
+    # exact pixels. Snips that differ in a single character often have the same
+    # perceptual hash, so keys for cached replies need both.
+    pixels = image.convertToFormat(QImage.Format.Format_RGB32)
+    digest = hashlib.sha256(pixels.constBits().asstring(pixels.sizeInBytes()))
+    return f"{perceptual_hash(image)}:{digest.hexdigest()}"
+
+
+def gray_thumbnail(image: QImage, size: int = 32) -> bytes:
+    # size x size grayscale pixels, for comparing frames cheaply
+    thumb = image.convertToFormat(QImage.Format.Format_Grayscale8).scaled(
+        size,
+        size,
+        Qt.AspectRatioMode.IgnoreAspectRatio,
+        Qt.TransformationMode.SmoothTransformation,
+    )
+    data = thumb.constBits().asstring(thumb.sizeInBytes())
+    row_bytes = thumb.bytesPerLine()
+    return b"".join(data[y * row_bytes : y * row_bytes + size] for y in range(size))
+
+
+def thumbnail_difference(a: bytes, b: bytes, tolerance: int = 24) -> float:
+    # Fraction of pixels that differ by more than tolerance gray levels, so that
+    # noise and small shifts in antialiasing do not count as a change
+    if len(a) != len(b):
+        return 1.0
+    return sum(abs(x - y) > tolerance for x, y in zip(a, b)) / max(len(a), 1)
+
+
+class PreprocessPolicy:
+    def __init__(
+        self,
+        tile_size: int = 512,
+        max_tiles: int = 4,
+        max_short_edge: int = 768,
+        photo_format: str = "JPEG",
+        photo_quality: int = 85,
+        photo_threshold: float = 0.25,
+        grayscale: bool = False,
+    ):
+        # The provider downscales anything larger than this anyway, so larger
+        # images only cost upload time
+        self.max_long_edge = tile_size * max_tiles
+        self.max_short_edge = max_short_edge
+        # Lossy format for photographic content, text stays lossless PNG
+        self.photo_format = photo_format
+        self.photo_quality = photo_quality
+        self.photo_threshold = photo_threshold
+        self.grayscale = grayscale
+
+
+def supported_format(fmt: str) -> str:
+    # WebP needs the Qt imageformats plugin, fall back to JPEG without it
+    supported = [bytes(f).lower() for f in QImageWriter.supportedImageFormats()]
+    if fmt.lower().encode() in supported:
+        return fmt
+    return "JPEG"
+
+
+def preprocess_image(image: QImage, policy: PreprocessPolicy):
+    # Returns the encoded image, its MIME type and its final size
+    if policy.grayscale:
+        image = image.convertToFormat(QImage.Format.Format_Grayscale8)
+
+    width, height = image.width(), image.height()
+    scale = min(
+        1.0,
+        policy.max_long_edge / max(width, height),
+        policy.max_short_edge / min(width, height),
+    )
+    if scale < 1.0:
+        image = image.scaled(
+            max(1, round(width * scale)),
+            max(1, round(height * scale)),
+            Qt.AspectRatioMode.IgnoreAspectRatio,
+            Qt.TransformationMode.SmoothTransformation,
+        )
+
+    if color_ratio(image) > policy.photo_threshold:
+        fmt = supported_format(policy.photo_format)
+        data = image_to_bytes(image, fmt, policy.photo_quality)
+        mime_type = f"image/{fmt.lower()}"
+    else:
+        data = image_to_bytes(image)
+        mime_type = "image/png"
+    return data, mime_type, image.width(), image.height()
+
+
+class SharedEncoding:
+    # Prepares an image for upload once for several requests. Whichever request
+    # needs it first does the work on its thread, the others wait for it.
+    def __init__(self, image: QImage, policy: PreprocessPolicy):
+        self.image = image
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.result = None
+
+    def get(self) -> tuple[str, int, int]:
+        # The data URL and the size of the uploaded image
+        with self.lock:
+            if self.result is None:
+                data, mime_type, width, height = preprocess_image(
+                    self.image, self.policy
+                )
+                self.result = image_bytes_to_data_url(data, mime_type), width, height
+            return self.result
@@ -0,0 +1,137 @@
+import json
+import os
+import socket
+from typing import Callable, Optional
+
+from util import DATA_DIR
+
+# The running AI Snip listens here for requests from the command line client and
+# from further instances. One JSON object per line in either direction, every
+# request gets exactly one response with "ok" and either the result or "error".
+SOCKET_PATH = os.path.join(DATA_DIR, "aisnip.sock")
+# QLocalServer uses named pipes instead of Unix sockets on Windows
+SUPPORTED = hasattr(socket, "AF_UNIX")
+
+
+class NotRunning(Exception):
+    pass
+
+
+def send_request(
+    request: dict, timeout: Optional[float] = 5.0, path: str = SOCKET_PATH
+) -> dict:
+    # Raises NotRunning if no instance listens on path
+    if not SUPPORTED:
+        raise NotRunning("Unix sockets are not available on this platform")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(1.0)
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise NotRunning(str(e)) from None
+        sock.settimeout(timeout)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise ConnectionError("AI Snip closed the connection without a response")
+    return json.loads(line)
+
+
+def forward_to_running(request: dict, path: str = SOCKET_PATH) -> bool:
+    # For a second instance, True if a running one took the request
+    try:
+        return send_request(request, path=path).get("ok", False)
+    except (NotRunning, OSError, ValueError):
+        return False
+
+
+class IpcServer:
+    # Serves requests on the Qt event loop, handlers run on the GUI thread.
+    # handlers maps a command to a function taking the request and a respond
+    # function, which may be called later, e.g. once a model request finished.
+    def __init__(
+        self, handlers: dict[str, Callable[[dict, Callable], None]], path=SOCKET_PATH
+    ):
+        from PyQt6.QtNetwork import QLocalServer
+
+        self.handlers = handlers
+        self.path = path
+        self.server = QLocalServer()
+        # Only this user may connect
+        self.server.setSocketOptions(QLocalServer.SocketOption.UserAccessOption)
+        self.server.newConnection.connect(self.on_new_connection)
+        # Partial lines received per connection
+        self.buffers = {}
+
+    def listen(self) -> bool:
+        # False if another instance is already listening. With UserAccessOption
+        # Qt replaces an existing socket file instead of failing, so a running
+        # instance has to be detected before.
+        from PyQt6.QtNetwork import QLocalServer
+
+        if not SUPPORTED:
+            return False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            send_request({"command": "ping"}, path=self.path)
+            return False
+        except (NotRunning, OSError, ValueError):
+            pass
+        # Left behind by an instance that did not shut down, if it exists
+        QLocalServer.removeServer(self.path)
+        return self.server.listen(self.path)
+
+    def close(self):
+        self.server.close()
+
+    def on_new_connection(self):
+        while self.server.hasPendingConnections():
+            connection = self.server.nextPendingConnection()
+            self.buffers[connection] = b""
+            connection.readyRead.connect(lambda c=connection: self.on_ready_read(c))
+            connection.disconnected.connect(
+                lambda c=connection: self.on_disconnected(c)
+            )
+
+    def on_disconnected(self, connection):
+        self.buffers.pop(connection, None)
+        connection.deleteLater()
+
+    def on_ready_read(self, connection):
+        buffer = self.buffers.get(connection, b"") + connection.readAll().data()
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            self.handle(connection, line)
+        if connection in self.buffers:
+            self.buffers[connection] = buffer
+
+    def handle(self, connection, line: bytes):
+        def respond(response: dict):
+            if connection not in self.buffers:
+                return  # The client is gone
+            connection.write(json.dumps(response).encode() + b"\n")
+            connection.flush()
+
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            respond({"ok": False, "error": "Invalid request"})
+            return
+        # Exceptions must not escape, the Qt slot would abort the process
+        command = request.get("command")
+        handler = self.handlers.get(command) if isinstance(command, str) else None
+        if command == "ping":
+            respond({"ok": True})
+        elif handler is None:
+            respond({"ok": False, "error": f"Unknown command: {command}"})
+        else:
+            try:
+                handler(request, respond)
+            except Exception as e:
+                respond({"ok": False, "error": str(e)})
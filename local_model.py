@@ -0,0 +1,273 @@
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+from util import ModelWrapper, OpenAIModelWrapper
+
+# A 1x1 white PNG, to find out whether the local model accepts images
+PROBE_IMAGE_URL = (
+    "data:image/png;base64,"
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4//8/AAX+Av4N70a4"
+    "AAAAAElFTkSuQmCC"
+)
+
+
+def has_images(messages: list[dict]) -> bool:
+    return any(
+        isinstance(message["content"], list)
+        and any(part.get("type") == "image_url" for part in message["content"])
+        for message in messages
+    )
+
+
+class LocalModelWrapper(OpenAIModelWrapper):
+    # OpenAI compatible server on this machine, like the llama.cpp server or
+    # vLLM. Without a model_name the first model the server lists is used.
+    # Whether the model takes images is probed once, unless vision is given.
+    def __init__(
+        self,
+        base_url: str = "http://127.0.0.1:8080/v1",
+        model_name: Optional[str] = None,
+        vision: Optional[bool] = None,
+        health_interval: float = 10.0,
+        probe_interval: float = 60.0,
+        **kwargs,
+    ):
+        super().__init__(
+            model_name=model_name or "local",
+            api_key="local",
+            base_url=base_url,
+            **kwargs,
+        )
+        # Falling back is faster than retrying a server that is not up
+        self.client = self.client.with_options(max_retries=0)
+        self.detect_model = model_name is None
+        self.vision = vision
+        # Health checks are cached for health_interval seconds
+        self.health_interval = health_interval
+        self.health = None
+        self.health_checked = 0.0
+        self.health_lock = threading.Lock()
+        # A vision probe that failed other than by rejecting the image counts as
+        # no vision until probe_interval seconds later
+        self.probe_interval = probe_interval
+        self.probe_failed = 0.0
+        # The prewarm thread and requests must not probe at the same time
+        self.probe_lock = threading.Lock()
+
+    def health_check(self, timeout: float = 0.5) -> bool:
+        # True if the server answers and lists a model
+        with self.health_lock:
+            if time.monotonic() - self.health_checked < self.health_interval:
+                return self.health
+            import openai
+
+            try:
+                models = self.client.with_options(timeout=timeout).models.list()
+                ids = [model.id for model in models.data]
+                self.health = bool(ids)
+                if ids and self.detect_model:
+                    self.model_name = ids[0]
+            except openai.APIError:
+                self.health = False
+            self.health_checked = time.monotonic()
+            if not self.health:
+                self.count("failed_health_checks")
+            return self.health
+
+    def mark_unhealthy(self):
+        # After a failed request, until the next health check is due
+        with self.health_lock:
+            self.health = False
+            self.health_checked = time.monotonic()
+
+    def supports_vision(self) -> bool:
+        with self.probe_lock:
+            if self.vision is not None:
+                return self.vision
+            if time.monotonic() - self.probe_failed < self.probe_interval:
+                return False
+            import openai
+
+            try:
+                self.client.with_options(timeout=30.0).chat.completions.create(
+                    model=self.model_name,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": "Hi"},
+                                {
+                                    "type": "image_url",
+                                    "image_url": {"url": PROBE_IMAGE_URL},
+                                },
+                            ],
+                        }
+                    ],
+                    max_tokens=1,
+                )
+                self.vision = True
+            except openai.BadRequestError:
+                # Text only models reject image parts
+                self.vision = False
+            except openai.APIError as e:
+                # Down, timed out or failing on images, probed again later
+                self.probe_failed = time.monotonic()
+                self.count("failed_vision_probes")
+                if isinstance(e, openai.APIConnectionError):
+                    self.mark_unhealthy()
+                return False
+            return self.vision
+
+    def prewarm(self, min_interval: float = 60.0):
+        # Checks the server and its capabilities before the snip needs them
+        def check():
+            if self.health_check():
+                self.supports_vision()
+
+        threading.Thread(target=check, daemon=True).start()
+
+    def token_prices(self) -> tuple[float, float]:
+        return 0.0, 0.0
+
+
+class FallbackModelWrapper(ModelWrapper):
+    # Sends requests to the local model when it is up and can handle them, and
+    # to the hosted model otherwise, or when the local request fails before its
+    # first token.
+    def __init__(
+        self, local_model: LocalModelWrapper, hosted_model: ModelWrapper, cache=None
+    ):
+        super().__init__(None, local_model.model_name, cache=cache)
+        self.local_model = local_model
+        self.hosted_model = hosted_model
+
+    def use_local(self, messages: list[dict]) -> bool:
+        if not self.local_model.health_check():
+            return False
+        return not has_images(messages) or self.local_model.supports_vision()
+
+    def request(
+        self,
+        messages: list[dict[str, str]],
+        stream: bool,
+        callback: Optional[Callable[[str], None]],
+        kwargs: dict,
+    ) -> str:
+        import openai
+
+        self.local.usage = None
+        model = self.hosted_model
+        try:
+            use_local = self.use_local(messages)
+        except openai.APIError:
+            use_local = False
+            self.local_model.mark_unhealthy()
+            self.count("fallbacks")
+        if use_local:
+            started = False
+
+            def forward(delta):
+                nonlocal started
+                started = True
+                if callback is not None:
+                    callback(delta)
+
+            try:
+                reply = self.local_model.request(messages, stream, forward, kwargs)
+                model = self.local_model
+            except (openai.APIConnectionError, openai.InternalServerError):
+                if started:
+                    raise
+                self.local_model.mark_unhealthy()
+                self.count("fallbacks")
+        if model is self.hosted_model:
+            reply = self.hosted_model.request(messages, stream, callback, kwargs)
+
+        self.count(
+            "local_requests" if model is self.local_model else "hosted_requests"
+        )
+        usage = model.last_usage()
+        if usage is not None:
+            self.record_usage(usage)
+        return reply
+
+    def with_model(self, model_name: str) -> ModelWrapper:
+        # Routing only picks among the hosted models
+        return FallbackModelWrapper(
+            self.local_model,
+            self.hosted_model.with_model(model_name),
+            cache=self.cache,
+        )
+
+    def prewarm(self, min_interval: float = 60.0):
+        self.local_model.prewarm(min_interval)
+        self.hosted_model.prewarm(min_interval)
+
+    def stream_complete(
+        self, messages: list[dict[str, str]], on_send=None, **kwargs
+    ) -> Iterator[str]:
+        return self.stream_request(messages, dict(kwargs, on_send=on_send))
+
+    def structured_complete(self, *args, **kwargs):
+        # Structured outputs are left to the hosted model
+        return self.hosted_model.structured_complete(*args, **kwargs)
+
+    def token_prices(self) -> tuple[float, float]:
+        # Prices of a request that falls back
+        return self.hosted_model.token_prices()
+
+    def compute_cost(
+        self,
+        input_token_cost: Optional[float] = None,
+        output_token_cost: Optional[float] = None,
+    ) -> float:
+        # Only the hosted requests cost anything
+        return self.hosted_model.compute_cost(input_token_cost, output_token_cost)
+
+    def format(self) -> str:
+        local = self.local_model
+        health = {None: "unchecked", True: "up", False: "down"}[local.health]
+        vision = {None: "unknown", True: "yes", False: "no"}[local.vision]
+        return (
+            f"Local model {local.model_name} ({health}, vision: {vision}):"
+            f" {self.stats.get('local_requests', 0)} requests,"
+            f" {self.stats.get('hosted_requests', 0)} sent to"
+            f" {self.hosted_model.model_name},"
+            f" {self.stats.get('fallbacks', 0)} fell back after an error"
+        )
+
+
+if __name__ == "__main__":
+    # Offline check of the fallback against mock servers
+    from mock_server import MockServer
+    from util import image_content
+
+    hosted_server = MockServer(reply="hosted").start()
+    hosted = OpenAIModelWrapper(api_key="mock", base_url=hosted_server.base_url)
+    image_messages = [
+        {"role": "user", "content": image_content("Hi", PROBE_IMAGE_URL)}
+    ]
+    text_messages = [{"role": "user", "content": "Hi"}]
+
+    def check(name, image_status, expected_image, expected_text, vision):
+        server = MockServer(reply="local", image_status=image_status).start()
+        model = FallbackModelWrapper(LocalModelWrapper(server.base_url), hosted)
+        for _ in range(2):
+            assert model.complete(image_messages) == expected_image, name
+        assert model.complete(text_messages) == expected_text, name
+        assert model.local_model.vision == vision, name
+        # A failed probe is not repeated by the second image request
+        probes = model.local_model.stats.get("failed_vision_probes", 0)
+        assert probes == (image_status == 500), name
+        server.shutdown()
+        print(f"{name}: ok, {model.stats}")
+
+    check("vision", None, "local", "local", True)
+    check("no vision", 400, "hosted", "local", False)
+    check("probe error", 500, "hosted", "local", None)
+
+    down = FallbackModelWrapper(LocalModelWrapper("http://127.0.0.1:9/v1"), hosted)
+    assert down.complete(image_messages) == "hosted"
+    assert down.complete(text_messages) == "hosted"
+    print(f"down: ok, {down.stats}")
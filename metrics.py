@@ -0,0 +1,113 @@
+import bisect
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+# Upper bounds in ms of the histogram buckets, 25% apart from 1ms to ~3 minutes
+BUCKET_BOUNDS = [1.25**i for i in range(55)]
+
+
+class LatencyHistogram:
+    # Fixed log spaced buckets, so recording is O(log n) and memory is constant
+    # however long the app runs. Percentiles are accurate to one bucket (25%).
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, fraction: float) -> float:
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+        return 0.0
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / max(self.count, 1),
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    def __init__(self, path: Optional[str] = None):
+        # Written as JSON after every finished trace if set
+        self.path = path
+        self.histograms = {}
+        # Stages are recorded from the GUI and from worker threads
+        self.lock = threading.Lock()
+
+    def record(self, name: str, ms: float):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].record(ms)
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {name: h.summary() for name, h in self.histograms.items()}
+
+    def format(self) -> str:
+        lines = ["Latency in ms (p50 / p95 / p99, count)"]
+        for name, s in self.summary().items():
+            lines.append(
+                f"{name}: {s['p50']:.0f} / {s['p95']:.0f} / {s['p99']:.0f}"
+                f" ({s['count']})"
+            )
+        return "\n".join(lines)
+
+    def write(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class Trace:
+    # Timeline of one snip through the pipeline. Every mark records the time
+    # since the previous mark under its own name, span records the time between
+    # two earlier marks.
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.marks = {"start": time.perf_counter()}
+        self.last = self.marks["start"]
+
+    def mark(self, stage: str, record: bool = True):
+        # Only the first mark of a stage counts. Marks with record=False only
+        # note the time, for stages that overlap with others.
+        now = time.perf_counter()
+        with self.metrics.lock:
+            if stage in self.marks:
+                return
+            self.marks[stage] = now
+            if not record:
+                return
+            previous, self.last = self.last, now
+        self.metrics.record(stage, (now - previous) * 1000)
+
+    def span(self, name: str, from_stage: str, to_stage: str):
+        if from_stage in self.marks and to_stage in self.marks:
+            self.metrics.record(
+                name, (self.marks[to_stage] - self.marks[from_stage]) * 1000
+            )
+
+    def has(self, stage: str) -> bool:
+        return stage in self.marks
@@ -0,0 +1,197 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+# Stand-in for an OpenAI compatible chat completions endpoint, to exercise the
+# model wrappers without network access or API costs
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so that connection reuse of the client can be observed
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(
+                200,
+                {
+                    "object": "list",
+                    "data": [{"id": self.server.model_name, "object": "model"}],
+                },
+            )
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "Not found"}})
+            return
+        request = json.loads(body)
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.image_status is not None and b'"image_url"' in body:
+            # Like a text only model, or a server that fails on images
+            self.send_json(
+                self.server.image_status,
+                {"error": {"message": "Image input is not supported"}},
+            )
+            return
+        # Time to first token of a real endpoint
+        time.sleep(self.server.latency)
+
+        # Roughly one token per four characters of request
+        usage = {
+            "prompt_tokens": len(body) // 4,
+            "completion_tokens": len(self.server.reply.split()),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        model = request.get("model", self.server.model_name)
+
+        if request.get("stream"):
+            self.stream_reply(model, usage, request.get("stream_options") or {})
+            return
+        self.send_json(
+            200,
+            {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": self.server.reply},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            },
+        )
+
+    def stream_reply(self, model, usage, stream_options):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(choices, **extra):
+            return {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+                **extra,
+            }
+
+        words = self.server.reply.split(" ")
+        for i, word in enumerate(words):
+            if i > 0 and self.server.tokens_per_second:
+                time.sleep(1 / self.server.tokens_per_second)
+            content = word if i == 0 else " " + word
+            self.send_event(
+                chunk(
+                    [
+                        {
+                            "index": 0,
+                            "delta": {"role": "assistant", "content": content},
+                            "finish_reason": None,
+                        }
+                    ]
+                )
+            )
+        self.send_event(chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if stream_options.get("include_usage"):
+            self.send_event(chunk([], usage=usage))
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def send_event(self, event):
+        self.send_chunk(f"data: {json.dumps(event)}\n\n".encode())
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        reply: str = "This is a reply from the mock server.",
+        model_name: str = "gpt-4o",
+        latency: float = 0.0,
+        tokens_per_second: Optional[float] = None,
+        image_status: Optional[int] = None,
+    ):
+        # latency is the delay in seconds before a reply, tokens_per_second the
+        # streaming speed with one word per token, unlimited if None.
+        # image_status is the error status of requests with images, if any.
+        super().__init__((host, port), MockHandler)
+        self.reply = reply
+        self.model_name = model_name
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.image_status = image_status
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        # Serve on a daemon thread, stop with shutdown()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--reply", default="This is a reply from the mock server.")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", type=float)
+    args = parser.parse_args()
+
+    server = MockServer(
+        args.host,
+        args.port,
+        args.reply,
+        latency=args.latency_ms / 1000,
+        tokens_per_second=args.tokens_per_second,
+    )
+    print(f"Serving on {server.base_url}")
+    server.serve_forever()
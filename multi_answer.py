@@ -0,0 +1,109 @@
+import sys
+from PyQt6.QtCore import Qt, pyqtSignal
+from PyQt6.QtGui import QFont
+from PyQt6.QtWidgets import (
+    QApplication,
+    QHBoxLayout,
+    QLabel,
+    QPlainTextEdit,
+    QPushButton,
+    QTabWidget,
+    QVBoxLayout,
+    QWidget,
+)
+import pyperclip
+
+
+class AnswerTab(QWidget):
+    # The streamed reply to one prompt, with a button to copy it
+    def __init__(self, font: QFont):
+        super().__init__()
+        layout = QVBoxLayout()
+        self.text_edit = QPlainTextEdit(self)
+        self.text_edit.setReadOnly(True)
+        self.text_edit.setFont(font)
+        self.text_edit.setPlaceholderText("Thinking...")
+
+        buttons = QHBoxLayout()
+        self.status = QLabel("Waiting for the reply")
+        self.copy_button = QPushButton("Copy", self)
+        self.copy_button.clicked.connect(self.copy)
+        buttons.addWidget(self.status)
+        buttons.addStretch()
+        buttons.addWidget(self.copy_button)
+
+        layout.addWidget(self.text_edit)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+
+    def append_text(self, text):
+        cursor = self.text_edit.textCursor()
+        cursor.movePosition(cursor.MoveOperation.End)
+        cursor.insertText(text)
+
+    def set_text(self, text, status="Done"):
+        # The final reply, replaces what was streamed
+        if self.text_edit.toPlainText() != text:
+            self.text_edit.setPlainText(text)
+        self.status.setText(status)
+
+    def copy(self):
+        pyperclip.copy(self.text_edit.toPlainText())
+        self.status.setText("Copied")
+
+
+class MultiAnswerWidget(QWidget):
+    # Replies to several prompts for the same snip, one tab each
+    # Emitted when the window is closed while replies are still pending
+    cancel_requested = pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("AI Snip answers")
+        self.setWindowFlags(
+            Qt.WindowType.FramelessWindowHint | Qt.WindowType.WindowStaysOnTopHint
+        )
+        self.text_font = QFont("Tahoma", 12)
+        self.tabs = QTabWidget(self)
+        layout = QVBoxLayout()
+        layout.addWidget(self.tabs)
+        self.setLayout(layout)
+        self.answers = {}
+        self.pending = set()
+
+        self.resize(600, 400)
+        screen_geometry = QApplication.primaryScreen().geometry()
+        x = screen_geometry.width() - self.width() - 20
+        y = screen_geometry.height() - self.height() - 20
+        self.move(x, y)
+
+    def reset(self, names: list[str]):
+        self.tabs.clear()
+        self.answers = {}
+        for name in names:
+            self.answers[name] = AnswerTab(self.text_font)
+            self.tabs.addTab(self.answers[name], name.capitalize())
+        self.pending = set(names)
+
+    def append_text(self, name, text):
+        self.answers[name].append_text(text)
+
+    def finish(self, name, text, status="Done"):
+        self.answers[name].set_text(text, status)
+        self.pending.discard(name)
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key.Key_Escape or event.key() == Qt.Key.Key_Q:
+            if self.pending:
+                self.cancel_requested.emit()
+            self.close()
+
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = MultiAnswerWidget()
+    window.reset(["explain", "translate", "latex"])
+    window.append_text("explain", "This is a streamed reply.")
+    window.finish("latex", "\\frac{a}{b}")
+    window.show()
+    sys.exit(app.exec())
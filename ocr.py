@@ -0,0 +1,168 @@
+import csv
+from abc import ABC, abstractmethod
+import io
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from typing import Optional
+
+
+class OcrResult:
+    def __init__(self, text: str, confidence: float, elapsed_ms: float):
+        self.text = text
+        # Between 0 and 1, the mean word confidence weighted by word length
+        self.confidence = confidence
+        self.elapsed_ms = elapsed_ms
+
+
+class OcrEngine(ABC):
+    # Recognizes the text of an encoded image, None if there is none
+    @abstractmethod
+    def recognize(self, image_data: bytes) -> Optional[OcrResult]:
+        pass
+
+
+class TesseractEngine(OcrEngine):
+    # Runs the tesseract command line tool, which reads the image from stdin and
+    # writes one row per word with its confidence in TSV format
+    def __init__(
+        self,
+        languages: str,
+        command: str = "tesseract",
+        page_segmentation: int = 6,
+        timeout: float = 5.0,
+    ):
+        # Tesseract language codes joined by "+", e.g. "deu+fra"
+        self.languages = languages
+        self.command = command
+        # 6 is a single block of text, which is what a snip usually is
+        self.page_segmentation = page_segmentation
+        self.timeout = timeout
+
+    def available(self) -> bool:
+        return shutil.which(self.command) is not None
+
+    def recognize(self, image_data: bytes) -> Optional[OcrResult]:
+        start = time.perf_counter()
+        try:
+            result = subprocess.run(
+                [
+                    self.command,
+                    "stdin",
+                    "stdout",
+                    "-l",
+                    self.languages,
+                    "--psm",
+                    str(self.page_segmentation),
+                    "tsv",
+                ],
+                input=image_data,
+                capture_output=True,
+                timeout=self.timeout,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if result.returncode != 0:
+            return None
+        text, confidence = parse_tsv(result.stdout.decode("utf-8", "replace"))
+        if not text:
+            return None
+        return OcrResult(text, confidence, (time.perf_counter() - start) * 1000)
+
+
+def parse_tsv(tsv: str) -> tuple[str, float]:
+    # The recognized text with its line breaks, and its confidence
+    lines = {}
+    weighted = total = 0
+    rows = csv.DictReader(io.StringIO(tsv), delimiter="\t", quoting=csv.QUOTE_NONE)
+    for row in rows:
+        word = (row.get("text") or "").strip()
+        if row.get("level") != "5" or not word:
+            continue
+        confidence = float(row["conf"])
+        if confidence < 0:
+            continue
+        line = (row["page_num"], row["block_num"], row["par_num"], row["line_num"])
+        lines.setdefault(line, []).append(word)
+        weighted += confidence * len(word)
+        total += len(word)
+    text = "\n".join(" ".join(words) for words in lines.values())
+    return text, weighted / total / 100 if total else 0.0
+
+
+def estimate_text_tokens(text: str) -> int:
+    # Roughly four characters per token
+    return len(text) // 4 + 1
+
+
+def ocr_engine_from_env() -> Optional[OcrEngine]:
+    # Off unless AISNIP_OCR is "tesseract" and it is installed. The languages of
+    # the snipped text have to be given in AISNIP_OCR_LANGUAGES, as English
+    # alone would misread most of what is snipped to be translated.
+    if os.environ.get("AISNIP_OCR", "").lower() != "tesseract":
+        return None
+    languages = os.environ.get("AISNIP_OCR_LANGUAGES")
+    if not languages:
+        print("OCR is off, AISNIP_OCR_LANGUAGES is not set", file=sys.stderr)
+        return None
+    engine = TesseractEngine(languages)
+    return engine if engine.available() else None
+
+
+class OcrStats:
+    # What sending the recognized text instead of the snip saved. The latency
+    # saved is the difference of the mean request times of the snips of the
+    # same presets that were sent as images, less the time OCR took.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = 0
+        self.used = 0
+        self.ocr_ms = 0.0
+        self.tokens_saved = 0
+        self.bytes_saved = 0
+        self.request_ms = {"text": 0.0, "image": 0.0}
+        self.requests = {"text": 0, "image": 0}
+
+    def record_ocr(self, result: Optional[OcrResult], used: bool):
+        with self.lock:
+            self.attempts += 1
+            if result is not None:
+                self.ocr_ms += result.elapsed_ms
+            if used:
+                self.used += 1
+
+    def record_saving(self, image_tokens: int, text: str, image_bytes: int):
+        with self.lock:
+            self.tokens_saved += image_tokens - estimate_text_tokens(text)
+            self.bytes_saved += image_bytes - len(text.encode())
+
+    def record_request(self, kind: str, ms: float):
+        # kind is "text" or "image"
+        with self.lock:
+            self.request_ms[kind] += ms
+            self.requests[kind] += 1
+
+    def latency_saved_ms(self) -> Optional[float]:
+        # Per snip sent as text, None until there are requests of both kinds
+        with self.lock:
+            if not self.requests["text"] or not self.requests["image"]:
+                return None
+            image_ms = self.request_ms["image"] / self.requests["image"]
+            text_ms = self.request_ms["text"] / self.requests["text"]
+            return image_ms - text_ms - self.ocr_ms / max(self.attempts, 1)
+
+    def format(self) -> str:
+        latency_saved = self.latency_saved_ms()
+        with self.lock:
+            line = (
+                f"OCR: {self.used} of {self.attempts} snips sent as text,"
+                f" ~{self.tokens_saved} tokens and"
+                f" {self.bytes_saved / 1024:.0f}KB upload saved,"
+                f" {self.ocr_ms / max(self.attempts, 1):.0f}ms per OCR"
+            )
+        if latency_saved is not None:
+            line += f", {latency_saved:.0f}ms faster per snip"
+        return line
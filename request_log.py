@@ -0,0 +1,107 @@
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+
+def strip_images(messages: list[dict]) -> list[dict]:
+    # Replace inline images by their hash and size, the log should record which
+    # image was sent, not contain megabytes of base64
+    stripped = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                url = part.get("image_url", {}).get("url", "")
+                if part.get("type") == "image_url" and url.startswith("data:"):
+                    header, _, data = url.partition(",")
+                    part = {
+                        "type": "image_url",
+                        "image": {
+                            "mime_type": header[len("data:") :].split(";")[0],
+                            "sha256": hashlib.sha256(data.encode()).hexdigest(),
+                            "base64_bytes": len(data),
+                        },
+                    }
+                parts.append(part)
+            message = {**message, "content": parts}
+        stripped.append(message)
+    return stripped
+
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def get_request_logger(path: str) -> "RequestLogger":
+    # One logger per file, wrappers that log to the same path share its writer
+    # thread instead of interleaving and rotating the file under each other
+    key = os.path.abspath(path)
+    with _loggers_lock:
+        if key not in _loggers:
+            _loggers[key] = RequestLogger(path)
+        return _loggers[key]
+
+
+class RequestLogger:
+    # Appends one JSON line per request from a background thread, so that logging
+    # costs the request path no more than a queue put. The file is gzipped and
+    # rotated once it exceeds max_bytes.
+    def __init__(
+        self, path: str, max_bytes: int = 10 * 1024 * 1024, backups: int = 5
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, messages: list[dict], reply: dict, **fields):
+        # fields are additional entries of the line, like latency and usage
+        self.queue.put((time.time(), messages, reply, fields))
+
+    def run(self):
+        f = open(self.path, "a")
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, messages, reply, fields = item
+            entry = {
+                "time": timestamp,
+                **fields,
+                "messages": strip_images(messages),
+                "reply": reply,
+            }
+            f.write(json.dumps(entry) + "\n")
+            if f.tell() > self.max_bytes:
+                f.close()
+                self.rotate()
+                f = open(self.path, "a")
+            # Buffered writes, flushed whenever the queue runs empty
+            if self.queue.empty():
+                f.flush()
+        f.close()
+
+    def rotate(self):
+        # log.1.gz is the most recent backup, the oldest one is dropped
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}.gz"):
+                os.replace(f"{self.path}.{i}.gz", f"{self.path}.{i + 1}.gz")
+        with open(self.path, "rb") as src:
+            with gzip.open(f"{self.path}.1.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        os.remove(self.path)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
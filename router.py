@@ -0,0 +1,142 @@
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from util import ModelWrapper
+
+# Candidate models per prompt preset, in order of preference. The router takes
+# the first one that is healthy and within the budgets, so the light presets
+# upgrade to the large model and the others fall back to the small one.
+DEFAULT_ROUTES = {
+    "explain": ["gpt-4o", "gpt-4o-mini"],
+    "custom": ["gpt-4o", "gpt-4o-mini"],
+    "translate": ["gpt-4o-mini", "gpt-4o"],
+    "latex": ["gpt-4o-mini", "gpt-4o"],
+}
+
+
+class ModelProfile:
+    # Latency and errors of the recent requests to one model. Samples expire
+    # after max_age seconds, so a model that was skipped for being slow or
+    # failing gets another chance.
+    def __init__(self, window: int = 20, max_age: float = 600.0):
+        self.samples = deque(maxlen=window)
+        self.max_age = max_age
+
+    def record(self, latency_ms: float, ok: bool):
+        self.samples.append((time.monotonic(), latency_ms, ok))
+
+    def recent(self) -> list[tuple[float, float, bool]]:
+        cutoff = time.monotonic() - self.max_age
+        return [sample for sample in self.samples if sample[0] >= cutoff]
+
+    def latency_ms(self, min_samples: int = 3) -> Optional[float]:
+        # Median latency of the successful requests, None while there are too few
+        latencies = [latency for _, latency, ok in self.recent() if ok]
+        if len(latencies) < min_samples:
+            return None
+        return statistics.median(latencies)
+
+    def error_rate(self) -> float:
+        samples = self.recent()
+        if not samples:
+            return 0.0
+        return sum(not ok for _, _, ok in samples) / len(samples)
+
+
+class ModelRouter:
+    # Picks the model for a snip from the route of its preset. A candidate is
+    # skipped if its recent error rate is above max_error_rate, its estimated cost
+    # is above cost_budget (in dollars per request) or its median latency is above
+    # latency_budget_ms. Models other than the default share its client.
+    def __init__(
+        self,
+        model: ModelWrapper,
+        routes: Optional[dict[str, list[str]]] = None,
+        latency_budget_ms: Optional[float] = None,
+        cost_budget: Optional[float] = None,
+        max_error_rate: float = 0.5,
+        expected_output_tokens: int = 300,
+    ):
+        self.model = model
+        self.routes = DEFAULT_ROUTES if routes is None else routes
+        self.latency_budget_ms = latency_budget_ms
+        self.cost_budget = cost_budget
+        self.max_error_rate = max_error_rate
+        self.expected_output_tokens = expected_output_tokens
+        self.models = {model.model_name: model}
+        self.profiles = {}
+        # Requests are recorded from worker threads
+        self.lock = threading.Lock()
+
+    def get_model(self, model_name: str) -> ModelWrapper:
+        if model_name not in self.models:
+            self.models[model_name] = self.model.with_model(model_name)
+        return self.models[model_name]
+
+    def profile(self, model_name: str) -> ModelProfile:
+        if model_name not in self.profiles:
+            self.profiles[model_name] = ModelProfile()
+        return self.profiles[model_name]
+
+    def estimate_cost(self, model: ModelWrapper, input_tokens: int) -> Optional[float]:
+        try:
+            return model.estimate_cost(input_tokens, self.expected_output_tokens)
+        except ValueError:
+            return None  # No pricing for this model
+
+    def choose(self, preset: str, input_tokens: int) -> ModelWrapper:
+        names = self.routes.get(preset) or [self.model.model_name]
+        fallback = None
+        with self.lock:
+            for name in names:
+                model = self.get_model(name)
+                profile = self.profile(name)
+                if profile.error_rate() > self.max_error_rate:
+                    continue
+                cost = self.estimate_cost(model, input_tokens)
+                if self.cost_budget is not None and cost is not None:
+                    if cost > self.cost_budget:
+                        continue
+                # Healthy and affordable, used if none is fast enough
+                fallback = fallback or model
+                latency = profile.latency_ms()
+                if self.latency_budget_ms is not None and latency is not None:
+                    if latency > self.latency_budget_ms:
+                        continue
+                return model
+            if fallback is not None:
+                return fallback
+            # Everything is failing or too expensive, take the least failing one
+            name = min(names, key=lambda name: self.profile(name).error_rate())
+            return self.get_model(name)
+
+    def record(self, model_name: str, latency_ms: float, ok: bool):
+        with self.lock:
+            self.profile(model_name).record(latency_ms, ok)
+
+    def complete(self, model: ModelWrapper, messages: list[dict], **kwargs) -> str:
+        # model.complete, with its latency and errors added to the profile
+        import openai
+
+        start = time.perf_counter()
+        try:
+            reply = model.complete(messages, **kwargs)
+        except openai.APIError:
+            self.record(model.model_name, (time.perf_counter() - start) * 1000, False)
+            raise
+        self.record(model.model_name, (time.perf_counter() - start) * 1000, True)
+        return reply
+
+    def format(self) -> str:
+        lines = ["Models (median latency in ms, error rate)"]
+        with self.lock:
+            for name, profile in self.profiles.items():
+                latency = profile.latency_ms(min_samples=1)
+                lines.append(
+                    f"{name}: {'-' if latency is None else f'{latency:.0f}'}"
+                    f", {profile.error_rate():.0%}"
+                )
+        return "\n".join(lines)
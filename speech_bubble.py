@@ -1,13 +1,103 @@
 from PyQt6.QtWidgets import QApplication, QWidget, QLabel
+import re
 import sys
-from PyQt6.QtCore import Qt, QTimer, QRectF, QPointF, QRect
+import time
+from PyQt6.QtCore import Qt, QTimer, QRectF, QPointF, QRect, pyqtSignal
 from PyQt6.QtGui import QPainter, QColor, QFont, QFontMetrics, QPainterPath, QPixmap
 from functools import lru_cache
 from util import resource_path
 
 
+# A word is anything between spaces, newlines are tokens of their own
+WORD_RE = re.compile(r"\n|[^ \n]+")
+
+
+class TextLayout:
+    # Word wraps a text once and keeps the line breaks, so that revealing more of
+    # it is an index lookup instead of re-measuring the text on every frame.
+    # Appending to the text only re-wraps its last line.
+    def __init__(self, metrics: QFontMetrics):
+        self.metrics = metrics
+        self.space_width = metrics.horizontalAdvance(" ")
+        self.word_widths = {}
+        self.text = ""
+        self.max_width = None
+        self.lines = []  # (start, end) character indices of finished lines
+        self.open_start = 0
+        self.open_line = None
+
+    def set_text(self, text: str, max_width: int):
+        if max_width != self.max_width or not text.startswith(self.text):
+            self.max_width = max_width
+            self.lines = []
+            self.open_start = 0
+        elif text == self.text:
+            return
+        self.text = text
+        self.wrap(self.open_start)
+
+    def word_width(self, word: str) -> int:
+        width = self.word_widths.get(word)
+        if width is None:
+            if len(self.word_widths) > 10000:
+                self.word_widths.clear()
+            width = self.metrics.horizontalAdvance(word)
+            self.word_widths[word] = width
+        return width
+
+    def wrap(self, pos: int):
+        line_start = line_end = None
+        width = 0
+        for match in WORD_RE.finditer(self.text, pos):
+            if match.group() == "\n":
+                if line_start is None:
+                    line_start = line_end = match.start()
+                self.lines.append((line_start, line_end))
+                line_start = None
+                self.open_start = match.end()
+                continue
+
+            word_width = self.word_width(match.group())
+            if line_start is None:
+                line_start, line_end, width = match.start(), match.end(), word_width
+                continue
+            gap = self.space_width * (match.start() - line_end)
+            if width + gap + word_width > self.max_width:
+                self.lines.append((line_start, line_end))
+                self.open_start = match.start()
+                line_start, line_end, width = match.start(), match.end(), word_width
+            else:
+                line_end = match.end()
+                width += gap + word_width
+        self.open_line = None if line_start is None else (line_start, line_end)
+
+    def line_count(self) -> int:
+        return len(self.lines) + (self.open_line is not None)
+
+    def visible_lines(self, char_index: int) -> list[str]:
+        # The lines showing the first char_index characters of the text
+        visible = []
+        lines = self.lines + ([self.open_line] if self.open_line else [])
+        for start, end in lines:
+            if start >= char_index:
+                break
+            visible.append(self.text[start : min(end, char_index)])
+        return visible
+
+
 class SpeechBubbleWidget(QWidget):
-    def __init__(self):
+    # Emitted when the user closes the bubble while a request is still pending
+    cancel_requested = pyqtSignal()
+    # Emitted when the first character of a reply and when all of it is shown
+    first_char_shown = pyqtSignal()
+    revealed = pyqtSignal()
+
+    def __init__(
+        self,
+        chars_per_second: float = 50.0,
+        max_reveal_duration: float = 2.0,
+        fade_duration: float = 0.25,
+    ):
         super().__init__()
         self.setWindowTitle("Speech Bubble")
         self.setWindowFlags(
@@ -28,57 +118,124 @@ class SpeechBubbleWidget(QWidget):
         self.img_height = int(self.pixmap.height() * scale_factor)
         self.img_width = int(self.pixmap.width() * scale_factor)
 
-    def reset(self, text):
-        self.full_text = text
+        self.full_text = ""
         self.displayed_text = ""
         self.char_index = 0
+        self.thinking = False
+        # Set from show_thinking until the owner calls finish_stream, closing the
+        # bubble in between cancels the request
+        self.streaming = False
+
+        # The typewriter reveals chars_per_second, faster if needed to show all
+        # of the text within max_reveal_duration seconds, whatever the frame rate
+        self.chars_per_second = chars_per_second
+        self.max_reveal_duration = max_reveal_duration
+        self.fade_duration = fade_duration
+        self.reveal_start = 0.0
+        self.last_tick = 0.0
+        self.reveal_position = 0.0
         self.opacity = 0.0
 
-        bubble_width = 300 + max(0, min(300, (len(self.full_text) - 100) // 2))
-        self.resize(bubble_width, 150)
-
-        # Timer for the typewriter effect
+        # Only runs while the bubble is visible and revealing
         self.timer = QTimer(self)
+        self.timer.setInterval(16)
         self.timer.timeout.connect(self.update_text)
-        self.timer.start(20)  # Adjust the interval as needed (milliseconds)
 
-    def update_text(self):
-        # Add one more character each time the timer fires
-        if self.opacity > 0.25:
-            if self.char_index < len(self.full_text):
-                self.char_index += 1
-                self.displayed_text = self.full_text[: self.char_index]
-                self.update()  # Trigger a repaint
-            elif self.opacity == 1.0:
-                self.timer.stop()  # Stop timer when all characters are displayed
-        if self.opacity < 1.0:
-            self.opacity = min(1.0, self.opacity + 0.01)
-            self.setWindowOpacity(self.opacity)
+        self.text_font = QFont("Tahoma", 12)
+        self.metrics = QFontMetrics(self.text_font)
+        self.text_layout = TextLayout(self.metrics)
 
-    @staticmethod
-    def compute_height(text: str, metrics: QFontMetrics, max_width: int):
-        # Split displayed_text into lines to fit within max_width
-        words = [x for x in text.replace("\n", " \n ").split(" ") if x]
-        lines = []
-        current_line = ""
-
-        for word in words:
-            test_line = current_line + " " + word if current_line else word
-            if word == "\n":
-                lines.append(current_line)
-                current_line = ""
-            elif metrics.horizontalAdvance(test_line) > max_width:
-                lines.append(current_line)
-                current_line = word  # Start a new line with the current word
-            else:
-                current_line = test_line  # Add word to the current line
+    def show_thinking(self):
+        # Placeholder shown while the model request runs in the background
+        self.reset("Thinking...")
+        self.thinking = True
+        self.streaming = True
 
-        # Append the last line
-        if current_line:
-            lines.append(current_line)
+    def finish_stream(self):
+        # The reply is complete, failed or was cancelled
+        self.streaming = False
 
-        line_req = metrics.height() * len(lines)
-        return lines, line_req
+    def reset(self, text, animate=True):
+        self.thinking = False
+        self.full_text = text
+        self.displayed_text = ""
+        self.char_index = 0
+        self.reveal_position = 0.0
+        self.reveal_start = self.last_tick = time.perf_counter()
+        self.opacity = 0.0
+
+        self.resize(self.bubble_width(), 150)
+        if not animate:
+            # Show the whole text right away, e.g. for cached replies
+            self.skip_to_end()
+            return
+        self.setWindowOpacity(self.opacity)
+        self.start_timer()
+
+    def append_text(self, text):
+        # Extend the text of a streamed reply, the typewriter catches up with it
+        if self.thinking:
+            self.reset("")
+        self.full_text += text
+        self.resize(self.bubble_width(), self.height())
+        self.start_timer()
+
+    def start_timer(self):
+        if self.isVisible() and not self.timer.isActive():
+            self.last_tick = time.perf_counter()
+            self.timer.start()
+
+    def skip_to_end(self):
+        # Show everything that has arrived so far
+        self.timer.stop()
+        was_empty = self.char_index == 0
+        self.char_index = len(self.full_text)
+        self.reveal_position = float(self.char_index)
+        self.displayed_text = self.full_text
+        self.opacity = 1.0
+        self.setWindowOpacity(self.opacity)
+        self.update()
+        if not self.thinking:
+            if was_empty:
+                self.first_char_shown.emit()
+            self.revealed.emit()
+
+    def bubble_width(self):
+        return 300 + max(0, min(300, (len(self.full_text) - 100) // 2))
+
+    def update_text(self):
+        now = time.perf_counter()
+        elapsed = now - self.reveal_start
+        dt, self.last_tick = now - self.last_tick, now
+
+        remaining = len(self.full_text) - self.reveal_position
+        time_left = self.reveal_start + self.max_reveal_duration - now
+        if time_left <= 0:
+            # Out of time, streamed text is shown as it arrives
+            self.reveal_position = float(len(self.full_text))
+        elif remaining > 0:
+            rate = max(self.chars_per_second, remaining / time_left)
+            self.reveal_position = min(
+                len(self.full_text), self.reveal_position + rate * dt
+            )
+
+        char_index = int(self.reveal_position)
+        if char_index != self.char_index:
+            was_empty = self.char_index == 0
+            self.char_index = char_index
+            self.displayed_text = self.full_text[:char_index]
+            self.update()
+            if was_empty and not self.thinking:
+                self.first_char_shown.emit()
+
+        if self.opacity < 1.0:
+            self.opacity = min(1.0, elapsed / self.fade_duration)
+            self.setWindowOpacity(self.opacity)
+        elif self.char_index >= len(self.full_text):
+            # Idle until more text is appended
+            self.timer.stop()
+            if not self.thinking:
+                self.revealed.emit()
 
     def paintEvent(self, event):
         # Set the window location to the bottom right corner
@@ -91,13 +248,14 @@ class SpeechBubbleWidget(QWidget):
 
         # Set bubble rectangle size and position, convert to QRectF
 
-        font = QFont("Tahoma", 12)
-        painter.setFont(font)
-        metrics = QFontMetrics(font)
+        painter.setFont(self.text_font)
+        metrics = self.metrics
         max_width = self.rect().width() - 60  # Padding for text within bubble
 
-        lines, line_req = self.compute_height(self.displayed_text, metrics, max_width)
-        _, max_req = self.compute_height(self.full_text, metrics, max_width)
+        self.text_layout.set_text(self.full_text, max_width)
+        lines = self.text_layout.visible_lines(self.char_index)
+        line_req = metrics.height() * len(lines)
+        max_req = metrics.height() * self.text_layout.line_count()
         diff = max_req - line_req
 
         total_height = max_req + 60 + self.img_height
@@ -167,9 +325,27 @@ class SpeechBubbleWidget(QWidget):
             )
             y_offset += line_height  # Move down for the next line
 
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.char_index < len(self.full_text) or self.opacity < 1.0:
+            self.start_timer()
+
+    def hideEvent(self, event):
+        # Nothing to animate while hidden, the reply is complete once reopened
+        super().hideEvent(event)
+        if self.timer.isActive():
+            self.skip_to_end()
+
+    def mousePressEvent(self, event):
+        self.skip_to_end()
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key.Key_Escape or event.key() == Qt.Key.Key_Q:
+            if self.streaming:
+                self.cancel_requested.emit()
             self.close()
+        else:
+            self.skip_to_end()
 
 
 if __name__ == "__main__":
@@ -1,14 +1,25 @@
+from __future__ import annotations
+
 import base64
-import json
+import math
+import queue
 import sys
 import os
+import threading
+import time
+from contextlib import closing
 from mimetypes import guess_type
-from typing import Optional, Type
+from typing import TYPE_CHECKING, Callable, Iterator, Optional, Type
+
+# The SDK takes long to import, it is only loaded once a model is created
+if TYPE_CHECKING:
+    import httpx
+    from openai._base_client import BaseClient
+    from openai.types.chat import ParsedChatCompletionMessage
+
 
-from openai import AzureOpenAI, OpenAI
-from openai._base_client import BaseClient
-from openai.types.chat import ParsedChatCompletionMessage
-from pydantic import BaseModel
+# Cache, logs and other state of AI Snip
+DATA_DIR = os.path.expanduser("~/.aisnip")
 
 
 # Source: https://learn.microsoft.com/en-us/azure/ai-services/openai/how-to/gpt-with-vision?tabs=rest
@@ -21,10 +32,136 @@ def local_image_to_data_url(image_path):
 
     # Read and encode the image file
     with open(image_path, "rb") as image_file:
-        base64_encoded_data = base64.b64encode(image_file.read()).decode("utf-8")
+        return image_bytes_to_data_url(image_file.read(), mime_type)
+
+
+def image_bytes_to_data_url(data: bytes, mime_type: str = "image/png") -> str:
+    # Straight from memory, without a round trip through a file. The base64
+    # bytes, their str and the URL are copies of about the encoded size each,
+    # encoding in chunks into one buffer measured no faster, as decoding that
+    # buffer to str copies it as well.
+    return f"data:{mime_type};base64," + base64.b64encode(data).decode("ascii")
+
+
+class BackgroundWriter:
+    # Writes files on a daemon thread so that archiving stays off the request path
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, path: str, data):
+        # data can also be a function returning the bytes, to move encoding off
+        # the calling thread as well
+        self.queue.put((path, data))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, data = item
+            try:
+                if callable(data):
+                    data = data()
+                with open(path, "wb") as f:
+                    f.write(data)
+            except OSError as e:
+                print(f"Could not write {path}: {e}", file=sys.stderr)
+
+    def close(self):
+        # Finish all queued writes
+        self.queue.put(None)
+        self.thread.join()
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    # Image token count as documented for the OpenAI vision models: the image is
+    # fit into 2048x2048, its short side scaled to 768 and then cut into 512px tiles
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+PROMPT_PRESETS = {
+    "explain": "Please explain the contents of this image concisely.",
+    "translate": (
+        "Translate this text to English. Only respond with the translated text."
+    ),
+    "custom": "",
+    "latex": (
+        "Give me the latex code that generates this image. Only respond with the"
+        " code and nothing else."
+    ),
+}
+
+
+def image_content(prompt: str, data_url: str) -> list[dict]:
+    # Message content asking prompt about an image
+    return [
+        {"type": "text", "text": prompt},
+        {"type": "image_url", "image_url": {"url": data_url}},
+    ]
+
+
+def text_content(prompt: str, text: str) -> list[dict]:
+    # Message content asking prompt about the text recognized in an image
+    return [
+        {"type": "text", "text": prompt},
+        {"type": "text", "text": f"The text in the image:\n{text}"},
+    ]
+
+
+# Connection pool settings of the HTTP client shared by all model wrappers
+HTTP_POOL_CONFIG = {
+    "max_connections": 10,
+    "max_keepalive_connections": 5,
+    "keepalive_expiry": 300.0,
+    "http2": True,
+}
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> httpx.Client:
+    # Shared keep-alive client, so that connections survive between snips and
+    # replacing a model wrapper does not leave a connection pool behind
+    import httpx
+
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            http2 = HTTP_POOL_CONFIG["http2"]
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    http2 = False  # httpx needs the optional h2 package for it
+            _http_client = httpx.Client(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=HTTP_POOL_CONFIG["max_connections"],
+                    max_keepalive_connections=HTTP_POOL_CONFIG[
+                        "max_keepalive_connections"
+                    ],
+                    keepalive_expiry=HTTP_POOL_CONFIG["keepalive_expiry"],
+                ),
+                timeout=httpx.Timeout(600.0, connect=10.0),
+            )
+        return _http_client
 
-    # Construct the data URL
-    return f"data:{mime_type};base64,{base64_encoded_data}"
+
+def close_http_client():
+    global _http_client
+    with _http_client_lock:
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
 
 
 def human_readable_parse(messages: list[dict[str, str]]):
@@ -40,48 +177,408 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
+class Flight:
+    # One running call of a SingleFlight, with the deltas streamed so far
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.parts = []
+        self.followers = 0
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def publish(self, delta: str):
+        with self.condition:
+            self.parts.append(delta)
+            self.condition.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self.condition:
+            self.result = result
+            self.error = error
+            self.done = True
+            self.condition.notify_all()
+
+    def follow(self, callback: Optional[Callable[[str], None]]):
+        # Replays the deltas so far to callback, then the new ones as they come
+        index = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.parts) > index or self.done)
+                parts = self.parts[index:]
+                done = self.done
+            index += len(parts)
+            if callback is not None:
+                for part in parts:
+                    callback(part)
+            if done:
+                break
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution of fn. The first
+    # caller runs it, the others follow its streamed deltas and get its result.
+    # If the first caller gives up (its callback raises) the call goes on for the
+    # followers, and is aborted once nobody is left.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def run(
+        self,
+        key: str,
+        fn: Callable[[Callable[[str], None]], str],
+        callback: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        # fn does the call and passes every delta to the function it is given
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight()
+                leader = True
+            else:
+                flight.followers += 1
+                leader = False
+
+        if not leader:
+            try:
+                return flight.follow(callback)
+            finally:
+                with self.lock:
+                    flight.followers -= 1
+
+        abandoned = None
+
+        def forward(delta):
+            nonlocal abandoned
+            flight.publish(delta)
+            if abandoned is None:
+                if callback is None:
+                    return
+                try:
+                    callback(delta)
+                    return
+                except BaseException as e:
+                    abandoned = e
+            # The first caller gave up, the call only goes on for its followers
+            with self.lock:
+                if flight.followers == 0:
+                    # Nobody can join an abandoned call anymore
+                    self.flights.pop(key, None)
+                    raise abandoned
+
+        try:
+            result = fn(forward)
+        except BaseException as e:
+            flight.finish(error=e)
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+        flight.finish(result=result)
+        if abandoned is not None:
+            raise abandoned
+        return result
+
+
+class StreamCancelled(Exception):
+    pass
+
+
 class ModelWrapper:
     def __init__(
-        self, client: BaseClient, model_name: str, log_file: Optional[str] = None
+        self,
+        client: BaseClient,
+        model_name: str,
+        log_file: Optional[str] = None,
+        cache=None,
     ):
         self.client = client
         self.model_name = model_name
         self.log_file = log_file
-        self.stats = {"requests": 0, "input_tokens": 0, "completion_tokens": 0}
+        self.logger = None
+        if log_file is not None:
+            from request_log import get_request_logger
+
+            self.logger = get_request_logger(log_file)
+        # Optional cache.ResponseCache, used for calls that pass a cache_key
+        self.cache = cache
+        self.last_prewarm = 0.0
+        # Requests can run on several threads at once
+        self.stats_lock = threading.Lock()
+        # Usage of the last request made on each thread
+        self.local = threading.local()
+        # Identical requests in flight at the same time share one upstream call
+        self.flights = SingleFlight()
+        self.stats = {
+            "requests": 0,
+            "input_tokens": 0,
+            "completion_tokens": 0,
+            "estimated_image_tokens": 0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+        }
+
+    def complete(
+        self,
+        messages: list[dict[str, str]],
+        stream: bool = False,
+        callback: Optional[Callable[[str], None]] = None,
+        cache_key: Optional[str] = None,
+        **kwargs,
+    ) -> str:
+        # Cache hits and followers of a shared request make no request of their
+        # own, so last_usage must not report the previous one of this thread
+        self.local.usage = None
+        if cache_key is None:
+            return self.request(messages, stream, callback, kwargs)
+
+        reply = self.cache_get(cache_key)
+        if reply is not None:
+            if callback is not None:
+                callback(reply)
+            return reply
+
+        def request(forward):
+            reply = self.request(messages, stream, forward, kwargs)
+            self.cache_put(cache_key, reply)
+            return reply
 
-    def complete(self, messages: list[dict[str, str]], **kwargs) -> str:
-        response = self.client.chat.completions.create(
-            model=self.model_name, messages=messages, **kwargs
+        return self.flights.run(cache_key, request, callback if stream else None)
+
+    def request(
+        self,
+        messages: list[dict[str, str]],
+        stream: bool,
+        callback: Optional[Callable[[str], None]],
+        kwargs: dict,
+    ) -> str:
+        self.local.usage = None
+        # Called right before the request goes out, e.g. to mark a trace
+        kwargs = dict(kwargs)
+        on_send = kwargs.pop("on_send", None)
+        if stream:
+            # Collect the streamed deltas, forwarding each one to the callback
+            parts = []
+            deltas = self.stream_complete(messages, on_send=on_send, **kwargs)
+            with closing(deltas):
+                for delta in deltas:
+                    parts.append(delta)
+                    if callback is not None:
+                        callback(delta)
+            reply = "".join(parts)
+        else:
+            if on_send is not None:
+                on_send()
+            start = time.perf_counter()
+            response = self.client.chat.completions.create(
+                model=self.model_name, messages=messages, **kwargs
+            )
+            self.record_usage(response.usage)
+            self.log(
+                messages, response.choices[0].message.dict(), start, response.usage
+            )
+            reply = response.choices[0].message.content
+        return reply
+
+    def with_model(self, model_name: str) -> ModelWrapper:
+        # Another model on the same client, connection pool, cache and log, with
+        # its own stats
+        model = ModelWrapper(self.client, model_name, cache=self.cache)
+        model.log_file = self.log_file
+        model.logger = self.logger
+        return model
+
+    def prewarm(self, min_interval: float = 60.0):
+        # Open a connection to the API host in the background, so that DNS, TCP
+        # and TLS setup are done by the time the snip is sent
+        now = time.monotonic()
+        if now - self.last_prewarm < min_interval:
+            return
+        self.last_prewarm = now
+
+        import httpx
+
+        def connect():
+            try:
+                self.client._client.head(str(self.client.base_url), timeout=10.0)
+            except httpx.HTTPError:
+                pass
+
+        threading.Thread(target=connect, daemon=True).start()
+
+    def cache_get(self, cache_key: str) -> Optional[str]:
+        if self.cache is None:
+            return None
+        reply = self.cache.get(cache_key)
+        self.count("cache_misses" if reply is None else "cache_hits")
+        return reply
+
+    def cache_put(self, cache_key: str, reply: str):
+        if self.cache is not None:
+            self.cache.put(cache_key, reply)
+
+    def stream_complete(
+        self,
+        messages: list[dict[str, str]],
+        on_send: Optional[Callable[[], None]] = None,
+        **kwargs,
+    ) -> Iterator[str]:
+        if on_send is not None:
+            on_send()
+        start = time.perf_counter()
+        stream = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs,
+        )
+        parts = []
+        usage = first_token = None
+        try:
+            for chunk in stream:
+                # The final chunk carries the usage and has no choices
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                    self.record_usage(usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Closing the stream early aborts the generation
+            stream.close()
+        self.log(
+            messages,
+            {"role": "assistant", "content": "".join(parts)},
+            start,
+            usage,
+            first_token_s=first_token,
         )
-        self.stats["requests"] += 1
-        self.stats["input_tokens"] += response.usage.prompt_tokens
-        self.stats["completion_tokens"] += response.usage.completion_tokens
-        if self.log_file is not None:
-            msg_copy = messages.copy()
-            msg_copy.append(response.choices[0].message.dict())
-            with open(self.log_file, "a") as f:
-                f.write(json.dumps(msg_copy) + ",\n")
-        return response.choices[0].message.content
+
+    def stream_request(self, messages: list[dict[str, str]], kwargs: dict):
+        # stream_complete for wrappers that only implement request(), like the
+        # composite ones. The request runs on a thread and passes its deltas
+        # through a queue, closing the generator aborts it at the next delta.
+        events = queue.Queue()
+        closed = threading.Event()
+
+        def forward(delta):
+            if closed.is_set():
+                raise StreamCancelled()
+            events.put(("delta", delta))
+
+        def run():
+            try:
+                self.request(messages, True, forward, kwargs)
+                events.put(("done", self.last_usage()))
+            except BaseException as e:
+                events.put(("error", e))
+
+        threading.Thread(target=run, daemon=True).start()
+        try:
+            while True:
+                kind, value = events.get()
+                if kind == "delta":
+                    yield value
+                elif kind == "done":
+                    # For last_usage on the thread that consumes the stream
+                    self.local.usage = value
+                    return
+                else:
+                    raise value
+        finally:
+            closed.set()
 
     def structured_complete(
-        self, messages: list[dict[str, str]], structure_class: Type, **kwargs
+        self,
+        messages: list[dict[str, str]],
+        structure_class: Type,
+        cache_key: Optional[str] = None,
+        **kwargs,
     ) -> ParsedChatCompletionMessage:
+        from openai.types.chat import ParsedChatCompletionMessage
+
+        if cache_key is not None:
+            cached = self.cache_get(cache_key)
+            if cached is not None:
+                return ParsedChatCompletionMessage[
+                    structure_class
+                ].model_validate_json(cached)
+
+        start = time.perf_counter()
         response = self.client.beta.chat.completions.parse(
             model=self.model_name,
             messages=messages,
             response_format=structure_class,
         )
-        self.stats["requests"] += 1
-        self.stats["input_tokens"] += response.usage.prompt_tokens
-        self.stats["completion_tokens"] += response.usage.completion_tokens
-        if self.log_file is not None:
-            msg_copy = messages.copy()
-            msg_copy.append(response.choices[0].message.dict())
-            with open(self.log_file, "a") as f:
-                f.write(json.dumps(msg_copy) + ",\n")
+        self.record_usage(response.usage)
+        self.log(messages, response.choices[0].message.dict(), start, response.usage)
 
+        if cache_key is not None:
+            self.cache_put(cache_key, response.choices[0].message.model_dump_json())
         return response.choices[0].message
 
+    def count(self, key: str, amount=1):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + amount
+
+    def record_usage(self, usage):
+        self.local.usage = usage
+        self.count("requests")
+        self.count("input_tokens", usage.prompt_tokens)
+        self.count("completion_tokens", usage.completion_tokens)
+
+    def last_usage(self):
+        # Usage of the last request this thread made, None if it made none
+        return getattr(self.local, "usage", None)
+
+    def log(
+        self,
+        messages: list[dict[str, str]],
+        reply: dict,
+        start: float,
+        usage=None,
+        **fields,
+    ):
+        # Hands the request to the background logger, start is the perf_counter
+        # time the request was sent
+        if self.logger is None:
+            return
+        if usage is not None:
+            fields["prompt_tokens"] = usage.prompt_tokens
+            fields["completion_tokens"] = usage.completion_tokens
+        self.logger.log(
+            messages,
+            reply,
+            model=self.model_name,
+            latency_s=round(time.perf_counter() - start, 3),
+            **fields,
+        )
+
+    def token_prices(self) -> tuple[float, float]:
+        # Cost per input and per output token
+        if "gpt-4o" in self.model_name:
+            if "mini" in self.model_name:
+                return 0.000165 / 1000, 0.00066 / 1000
+            elif "2024-08-06" in self.model_name:
+                return 0.0025 / 1000, 0.010 / 1000
+            else:
+                return 0.005 / 1000, 0.015 / 1000
+        elif "gpt-35" in self.model_name:
+            return 0.0005 / 1000, 0.0015 / 1000
+        else:
+            raise ValueError(
+                f"Unknown model name: {self.model_name}. Please provide"
+                " input_token_cost and output_token_cost."
+            )
+
     def compute_cost(
         self,
         input_token_cost: Optional[float] = None,
@@ -89,25 +586,7 @@ class ModelWrapper:
     ) -> float:
         if input_token_cost is None:
             assert output_token_cost is None
-            if "gpt-4o" in self.model_name:
-                if "mini" in self.model_name:
-                    input_token_cost = 0.000165 / 1000
-                    output_token_cost = 0.00066 / 1000
-                else:
-                    if "2024-08-06" in self.model_name:
-                        input_token_cost = 0.0025 / 1000
-                        output_token_cost = 0.010 / 1000
-                    else:
-                        input_token_cost = 0.005 / 1000
-                        output_token_cost = 0.015 / 1000
-            elif "gpt-35" in self.model_name:
-                input_token_cost = 0.0005 / 1000
-                output_token_cost = 0.0015 / 1000
-            else:
-                raise ValueError(
-                    f"Unknown model name: {self.model_name}. Please provide"
-                    " input_token_cost and output_token_cost."
-                )
+            input_token_cost, output_token_cost = self.token_prices()
 
         total_cost = (
             self.stats["input_tokens"] * input_token_cost
@@ -115,6 +594,60 @@ class ModelWrapper:
         )
         return total_cost
 
+    def estimate_cost(self, input_tokens: int, output_tokens: int = 0) -> float:
+        # Pre-flight cost of a request, e.g. from estimate_image_tokens
+        input_token_cost, output_token_cost = self.token_prices()
+        return input_tokens * input_token_cost + output_tokens * output_token_cost
+
+    def record_image_estimate(self, image_tokens: int):
+        self.count("estimated_image_tokens", image_tokens)
+
+
+def model_from_env(**kwargs) -> Optional[ModelWrapper]:
+    # With AISNIP_LOCAL_BASE_URL set, requests go to the local OpenAI compatible
+    # server there and fall back to the hosted model, if one is configured
+    base_url = os.environ.get("AISNIP_LOCAL_BASE_URL")
+    if not base_url:
+        return hosted_model_from_env(**kwargs)
+    from local_model import FallbackModelWrapper, LocalModelWrapper
+
+    # The backends share the cache of the composite, not their own
+    cache = kwargs.pop("cache", None)
+    hosted_model = hosted_model_from_env(**kwargs)
+    local_model = LocalModelWrapper(
+        base_url,
+        os.environ.get("AISNIP_LOCAL_MODEL") or None,
+        log_file=kwargs.get("log_file"),
+        cache=cache if hosted_model is None else None,
+    )
+    if hosted_model is None:
+        return local_model
+    return FallbackModelWrapper(local_model, hosted_model, cache=cache)
+
+
+def hosted_model_from_env(**kwargs) -> Optional[ModelWrapper]:
+    # Pick the backend from the configured credentials, None if there are none
+    if (
+        os.environ.get("OPENAI_API_KEY") is not None
+        and os.environ.get("AZURE_OPENAI_API_KEY") is not None
+    ):
+        # Both are configured, hedge slow requests to Azure
+        from hedge import HedgedModelWrapper
+
+        cache = kwargs.pop("cache", None)
+        return HedgedModelWrapper(
+            OpenAIModelWrapper(**kwargs), AzureModelWrapper(**kwargs), cache=cache
+        )
+    elif os.environ.get("OPENAI_API_KEY") is not None:
+        return OpenAIModelWrapper(**kwargs)
+    elif os.environ.get("AZURE_OPENAI_API_KEY") is not None:
+        return AzureModelWrapper(**kwargs)
+    elif os.path.isfile("openai_api_key.txt"):
+        with open("openai_api_key.txt") as f:
+            api_key = f.read().strip()
+        return OpenAIModelWrapper(api_key=api_key, **kwargs)
+    return None
+
 
 class OpenAIModelWrapper(ModelWrapper):
     def __init__(
@@ -122,11 +655,18 @@ class OpenAIModelWrapper(ModelWrapper):
         model_name: str = "gpt-4o",
         log_file=None,
         api_key=os.environ.get("OPENAI_API_KEY"),
+        cache=None,
+        base_url: Optional[str] = None,
+        http_client: Optional[httpx.Client] = None,
     ):
+        from openai import OpenAI
+
         self.client = OpenAI(
             api_key=api_key,
+            base_url=base_url,
+            http_client=http_client or get_http_client(),
         )
-        super().__init__(self.client, model_name, log_file)
+        super().__init__(self.client, model_name, log_file, cache)
 
 
 class AzureModelWrapper(ModelWrapper):
@@ -135,10 +675,15 @@ class AzureModelWrapper(ModelWrapper):
         model_name: str = "gpt-4o",
         log_file=None,
         api_version="2024-08-01-preview",
+        cache=None,
+        http_client: Optional[httpx.Client] = None,
     ):
+        from openai import AzureOpenAI
+
         self.client = AzureOpenAI(
             api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
             api_version=api_version,
             azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            http_client=http_client or get_http_client(),
         )
-        super().__init__(self.client, model_name, log_file)
+        super().__init__(self.client, model_name, log_file, cache)
@@ -0,0 +1,106 @@
+import time
+
+from PyQt6.QtCore import QObject, QRect, QTimer, pyqtSignal
+from PyQt6.QtGui import QImage
+from PyQt6.QtWidgets import QApplication
+
+from imaging import gray_thumbnail, thumbnail_difference
+
+
+class RegionWatcher(QObject):
+    # Re-grabs a rectangle of the screen on an interval and emits changed with
+    # the new frame when it differs from the last emitted one by more than
+    # threshold (fraction of changed thumbnail pixels). A frame is only emitted
+    # once it is stable, i.e. equal to the frame of the previous tick, so that
+    # scrolling or fading content is not sent half way.
+    #
+    # cpu_budget is the fraction of time the grabs and comparisons may take. If
+    # they are slower, the interval is stretched accordingly.
+    changed = pyqtSignal(QImage)
+
+    def __init__(
+        self,
+        rect: QRect,
+        prompt: str,
+        preset: str = "default",
+        interval_ms: int = 1000,
+        threshold: float = 0.02,
+        cpu_budget: float = 0.05,
+        sample_size: int = 32,
+        tolerance: int = 24,
+    ):
+        super().__init__()
+        # In global screen coordinates
+        self.rect = rect
+        self.prompt = prompt
+        self.preset = preset
+        self.interval_ms = interval_ms
+        self.threshold = threshold
+        self.cpu_budget = cpu_budget
+        self.sample_size = sample_size
+        self.tolerance = tolerance
+
+        # Set by the owner while the request for a frame runs, changes are then
+        # picked up on the first tick after it
+        self.busy = False
+        self.last_sent = None
+        self.last_frame = None
+        self.tick_ms = 0.0  # Moving average of the cost of one tick
+        self.stats = {"ticks": 0, "changes": 0}
+        self.active = False
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.tick)
+
+    def start(self, image: QImage = None):
+        # image is the frame the region was first snipped from, if any
+        if image is not None:
+            self.last_sent = self.last_frame = self.thumbnail(image)
+        self.active = True
+        self.timer.start(self.interval_ms)
+
+    def stop(self):
+        self.active = False
+        self.timer.stop()
+
+    def thumbnail(self, image: QImage) -> bytes:
+        return gray_thumbnail(image, self.sample_size)
+
+    def grab(self) -> QImage:
+        screen = QApplication.screenAt(self.rect.center())
+        if screen is None:
+            screen = QApplication.primaryScreen()
+        rect = self.rect.translated(-screen.geometry().topLeft())
+        return screen.grabWindow(
+            0, rect.x(), rect.y(), rect.width(), rect.height()
+        ).toImage()
+
+    def tick(self):
+        start = time.perf_counter()
+        image = self.grab()
+        frame = self.thumbnail(image)
+        stable = self.last_frame is not None and (
+            thumbnail_difference(frame, self.last_frame, self.tolerance)
+            <= self.threshold
+        )
+        self.last_frame = frame
+        changed = self.last_sent is None or (
+            thumbnail_difference(frame, self.last_sent, self.tolerance)
+            > self.threshold
+        )
+        ms = (time.perf_counter() - start) * 1000
+        if self.stats["ticks"] == 0:
+            self.tick_ms = ms
+        else:
+            self.tick_ms = 0.8 * self.tick_ms + 0.2 * ms
+        self.stats["ticks"] += 1
+
+        if changed and stable and not self.busy:
+            self.last_sent = frame
+            self.stats["changes"] += 1
+            self.changed.emit(image)
+        if self.active:
+            self.timer.start(
+                max(self.interval_ms, int(self.tick_ms / self.cpu_budget))
+            )
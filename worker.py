@@ -0,0 +1,49 @@
+from PyQt6.QtCore import QObject, QRunnable, pyqtSignal
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class CompletionSignals(QObject):
+    # Signals are emitted from the worker thread and delivered to the GUI thread
+    token = pyqtSignal(int, str)
+    finished = pyqtSignal(int, str)
+    failed = pyqtSignal(int, str)
+
+
+class CompletionWorker(QRunnable):
+    def __init__(self, request_id: int, fn, *args, streaming=False, **kwargs):
+        super().__init__()
+        self.request_id = request_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        if streaming:
+            # fn reports partial output through this callback
+            self.kwargs["on_token"] = self.emit_token
+        self.signals = CompletionSignals()
+        self.cancelled = False
+
+    def cancel(self):
+        # A streaming request is aborted at its next token, otherwise the result is
+        # dropped instead of reaching the GUI
+        self.cancelled = True
+
+    def emit_token(self, token: str):
+        if self.cancelled:
+            # Unwinds fn, which closes the response stream
+            raise RequestCancelled()
+        self.signals.token.emit(self.request_id, token)
+
+    def run(self):
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except RequestCancelled:
+            return
+        except Exception as e:
+            if not self.cancelled:
+                self.signals.failed.emit(self.request_id, str(e))
+            return
+        if not self.cancelled:
+            self.signals.finished.emit(self.request_id, result)